@@ -0,0 +1,171 @@
+"""
+Global bandwidth scheduler: one token bucket caps the combined throughput of
+every transfer, and jobs share it by priority and weight.
+
+Each job gets a Share from the scheduler and hands it to its downloader; the
+transfer loop asks the share for tokens after every chunk it reads. While a
+transfer waits for tokens it stops reading from the socket, so TCP slows the
+sender down too, and progress (and the rate the UI shows) follows the
+throttled throughput. The limit, weights and priorities can be changed while
+transfers are running.
+"""
+import threading
+import time
+
+# How often a waiting transfer re-checks whether it was cancelled, in seconds
+CANCEL_POLL_INTERVAL = 0.1
+# Default bucket depth, in seconds of the rate limit
+DEFAULT_BURST_SECONDS = 0.25
+
+_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_rate(text):
+    """Parses a rate such as "500K", "2M" or "1.5M" (bytes per second) into bytes per second. "0" means no limit."""
+    text = text.strip().upper()
+    # Suffixes stripped by hand; str.removesuffix needs Python 3.9
+    for suffix in ('/S', 'B'):
+        if text.endswith(suffix):
+            text = text[:-len(suffix)]
+    unit = text[-1:] if text[-1:] in _UNITS else ''
+    try:
+        value = float(text[:len(text) - len(unit)]) * _UNITS[unit]
+    except ValueError:
+        raise ValueError(f"Unrecognised rate '{text}', expected e.g. 500K or 2M")
+    if not 0 <= value < float('inf'):
+        raise ValueError(f"A rate must be zero or positive, got '{text}'")
+    return value or None
+
+
+def _limit(value, name):
+    """Checks a rate or burst given as a number, a string for parse_rate or None. 0 and None mean no limit."""
+    if isinstance(value, str):
+        return parse_rate(value)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value < float('inf'):
+        raise ValueError(f"A bandwidth {name} must be a number of bytes, zero or positive, got {value!r}.")
+    return value or None
+
+
+class Share:
+    """
+    One job's claim on the scheduler. Among jobs waiting for bandwidth, a
+    higher priority is always served first; jobs of equal priority split the
+    bandwidth in proportion to their weights.
+    """
+    def __init__(self, scheduler, weight=1.0, priority=0):
+        if weight <= 0:
+            raise ValueError("A bandwidth weight must be positive.")
+        self.scheduler = scheduler
+        self.weight = weight
+        self.priority = priority
+        self.granted = 0
+        # Virtual finish time of this job's last request, for fair queuing
+        self._finish = 0.0
+
+    def acquire(self, amount, cancelled=None):
+        """
+        Blocks until `amount` bytes may be transferred. Returns False, without
+        consuming anything, if `cancelled()` becomes true while waiting.
+        """
+        return self.scheduler._acquire(self, amount, cancelled)
+
+    def retune(self, weight=None, priority=None):
+        """Changes this job's weight or priority; applies to transfers already waiting."""
+        self.scheduler._retune(self, weight, priority)
+
+
+class BandwidthScheduler:
+    """
+    A token bucket refilled at `rate` bytes per second (None for no limit),
+    holding at most `burst` bytes. Waiting requests are granted in order of
+    (priority, virtual finish time), i.e. start-time fair queuing within
+    each priority level.
+    """
+    def __init__(self, rate=None, burst=None, clock=time.monotonic):
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._sequence = 0
+        self._virtual_time = 0.0
+        self.rate = None
+        self.burst = None
+        self._tokens = 0.0
+        self._last_refill = clock()
+        self.set_rate(rate, burst)
+
+    def share(self, weight=1.0, priority=0):
+        """A new Share for one job."""
+        return Share(self, weight, priority)
+
+    def set_rate(self, rate, burst=None):
+        """
+        Changes the limit while transfers are running. `rate` and `burst` are
+        numbers or strings such as "2M"; None or 0 lifts the limit. Invalid
+        values raise ValueError and leave the current limit in place.
+        """
+        rate, burst = _limit(rate, 'rate'), _limit(burst, 'burst')
+        with self._cond:
+            self._refill()
+            self.rate = rate
+            self.burst = burst or (rate * DEFAULT_BURST_SECONDS if rate else None)
+            if self.burst is not None:
+                self._tokens = min(self._tokens, self.burst)
+            self._cond.notify_all()
+
+    def _retune(self, share, weight, priority):
+        with self._cond:
+            if weight is not None:
+                if weight <= 0:
+                    raise ValueError("A bandwidth weight must be positive.")
+                share.weight = weight
+            if priority is not None:
+                share.priority = priority
+            # Re-tag the waiting requests of this share, so the change applies now
+            for request in self._waiting:
+                if request['share'] is share:
+                    request['finish'] = request['start'] + request['amount'] / share.weight
+            self._cond.notify_all()
+
+    def _refill(self):
+        now = self._clock()
+        if self.rate is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def _next_request(self):
+        return min(self._waiting, key=lambda r: (-r['share'].priority, r['finish'], r['sequence']))
+
+    def _acquire(self, share, amount, cancelled):
+        with self._cond:
+            if self.rate is None and not self._waiting:
+                share.granted += amount
+                return True
+
+            start = max(self._virtual_time, share._finish)
+            share._finish = start + amount / share.weight
+            self._sequence += 1
+            request = {'share': share, 'amount': amount, 'start': start,
+                       'finish': share._finish, 'sequence': self._sequence}
+            self._waiting.append(request)
+            try:
+                while True:
+                    if cancelled is not None and cancelled():
+                        return False
+                    self._refill()
+                    # A chunk bigger than the bucket is let through once the bucket is full, leaving a debt
+                    if self._next_request() is request and (self.rate is None or self._tokens >= min(amount, self.burst)):
+                        if self.rate is not None:
+                            self._tokens -= amount
+                        self._virtual_time = request['start']
+                        share.granted += amount
+                        return True
+                    if self._next_request() is request:
+                        timeout = (min(amount, self.burst) - self._tokens) / self.rate
+                    else:
+                        timeout = CANCEL_POLL_INTERVAL
+                    self._cond.wait(min(timeout, CANCEL_POLL_INTERVAL) if cancelled is not None else timeout)
+            finally:
+                self._waiting.remove(request)
+                self._cond.notify_all()
@@ -0,0 +1,299 @@
+"""
+Headless batch mode: pushes a list of URLs through the downloader core
+without the Tk window.
+
+Each line of the input is a URL, optionally followed by `|` and a policy
+that overrides the default one for that URL:
+
+    https://www.youtube.com/watch?v=aaaaaaaaaaa
+    https://www.youtube.com/watch?v=bbbbbbbbbbb | best audio mp3
+    https://www.youtube.com/watch?v=ccccccccccc | best 720p mp4 mkv
+    https://www.youtube.com/playlist?list=PLxxxxxxxx | best audio mp3
+
+Playlist and channel URLs expand into one job per video (see playlist.py);
+the first videos start downloading while the rest of the list is resolved,
+and a video listed more than once with the same policy is only downloaded
+once (a repeated URL line is reported as skipped).
+
+Downloads and ffmpeg conversions run in separate pools (see pipeline.py),
+so the next video downloads while the previous one converts.
+
+Every job is timed phase by phase (metadata, transfer, ffmpeg); see metrics.py.
+
+Usage:
+    python batch.py urls.txt -o downloads -p "best <=1080p mp4" -w 4 -t 2
+    cat urls.txt | python batch.py - -o downloads
+    python batch.py urls.txt --metrics-jsonl spans.jsonl --metrics-prom gaan.prom
+    python batch.py urls.txt --profile-job 3 --profile-out job3.prof
+    python batch.py urls.txt --limit 2M --audio-first
+    python batch.py urls.txt --stream
+"""
+import argparse
+import functools
+import os
+import sys
+import threading
+import time
+from concurrent.futures import as_completed
+
+from bandwidth import BandwidthScheduler, parse_rate
+from cache import MetadataCache
+from downloader import YouTubeDownloader
+from library import Library
+from metrics import MetricsRecorder, profiled
+from pipeline import Pipeline
+from playlist import DEFAULT_WORKERS as DEFAULT_EXPAND_WORKERS, PlaylistExpander, collection_kind
+
+DEFAULT_POLICY = "best <=1080p mp4"
+VIDEO_FORMATS = ('mp4', 'mov', 'avi', 'mkv')
+AUDIO_FORMATS = ('mp3', 'wav', 'm4a', 'aac')
+
+
+class Policy:
+    """
+    A format/quality rule applied to every video of a job, e.g.
+    "best <=1080p mp4", "best 720p mkv" or "best audio mp3". Several formats,
+    as in "best audio mp3 wav", are all written from one download.
+    """
+    def __init__(self, kind, file_formats, max_height=None):
+        self.kind = kind
+        self.file_formats = file_formats
+        self.max_height = max_height
+
+    @classmethod
+    def parse(cls, text):
+        kind, file_formats, max_height = 'video', [], None
+        for token in text.lower().replace('≤', '<=').split():
+            if token == 'best':
+                continue
+            elif token == 'audio':
+                kind = 'audio'
+            elif token.endswith('p') and token.lstrip('<=')[:-1].isdigit():
+                max_height = int(token.lstrip('<=')[:-1])
+            elif token in VIDEO_FORMATS + AUDIO_FORMATS:
+                if token not in file_formats:
+                    file_formats.append(token)
+            else:
+                raise ValueError(f"Unrecognised policy term '{token}' in '{text}'")
+
+        if not file_formats:
+            file_formats = ['mp3' if kind == 'audio' else 'mp4']
+        audio = [f for f in file_formats if f in AUDIO_FORMATS]
+        if audio and len(audio) != len(file_formats):
+            raise ValueError(f"Policy '{text}' mixes audio and video formats; use one line for each")
+        if audio:
+            kind = 'audio'
+        return cls(kind, file_formats, max_height)
+
+    def select_quality(self, video_info):
+        """Picks the resolution or bitrate from `get_video_info` output that satisfies the policy."""
+        if self.kind == 'audio':
+            if not video_info['audio_bitrates']:
+                raise ValueError("No audio streams available.")
+            return video_info['audio_bitrates'][0]
+
+        # Resolutions are already sorted best first
+        for resolution in video_info['video_resolutions']:
+            if self.max_height is None or int(resolution.replace('p', '')) <= self.max_height:
+                return resolution
+        raise ValueError(f"No video stream at or below {self.max_height}p.")
+
+    def __str__(self):
+        formats = " ".join(self.file_formats)
+        if self.kind == 'audio':
+            return f"best audio {formats}"
+        limit = f" <={self.max_height}p" if self.max_height else ""
+        return f"best{limit} {formats}"
+
+
+class JobResult:
+    def __init__(self, url, policy):
+        self.url = url
+        self.policy = policy
+        self.title = None
+        self.quality = None
+        self.bytes_downloaded = 0
+        self.started = None
+        self.elapsed = 0.0
+        self.error = None
+        self.skipped = None  # why the job was not run, e.g. a duplicate line
+
+
+def read_jobs(lines, default_policy):
+    """Turns input lines into (url, Policy) pairs, skipping blanks and # comments."""
+    jobs = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        url, _, policy_text = line.partition('|')
+        policy = Policy.parse(policy_text) if policy_text.strip() else default_policy
+        jobs.append((url.strip(), policy))
+    return jobs
+
+
+def fetch_job(result, save_path, metadata_cache=None, refresh=False, library=None, job_metrics=None, bandwidth=None,
+              cancel_event=None, streaming=False):
+    """
+    The download stage of one job. It uses its own downloader, so no per-video
+    state is shared between workers; only the (thread-safe) metadata cache is.
+    Returns the TranscodeTask the pipeline still has to run, if any.
+    """
+    lock = threading.Lock()
+
+    def count_bytes(stream, chunk, bytes_remaining):
+        with lock:
+            result.bytes_downloaded += len(chunk)
+
+    result.started = time.perf_counter()
+    downloader = YouTubeDownloader(count_bytes, metadata_cache=metadata_cache, library=library, job_metrics=job_metrics,
+                                   bandwidth=bandwidth, cancel_event=cancel_event, streaming=streaming)
+    video_info = downloader.get_video_info(result.url, refresh=refresh)
+    result.title = video_info['title']
+    result.quality = result.policy.select_quality(video_info)
+    if result.policy.kind == 'audio':
+        return downloader.fetch_audio(save_path, result.quality, audio_format=result.policy.file_formats)
+    return downloader.fetch_video(save_path, result.quality, video_format=result.policy.file_formats)
+
+
+def run_batch(jobs, save_path, pipeline, on_result=None, metadata_cache=None, refresh=False, library=None,
+              recorder=None, profile_job=None, profile_out=None, scheduler=None, audio_first=False, expander=None,
+              streaming=False):
+    """
+    Runs (url, Policy) jobs through the pipeline's download and transcode
+    pools and returns every JobResult. With a metrics.MetricsRecorder every
+    job's phases are timed; `profile_job` (1-based) runs that job's download
+    stage under cProfile and writes the stats to `profile_out`. With a
+    bandwidth.BandwidthScheduler all transfers share its limit, audio-only
+    jobs ahead of the rest if `audio_first` is set. With a
+    playlist.PlaylistExpander, playlist and channel URLs become one job per
+    video, each submitted as soon as it is expanded; a video already queued
+    with the same policy is not queued again. With `streaming` set, streams
+    are piped straight into ffmpeg instead of being saved to temp files first.
+    """
+    pending = {}
+    results = []
+
+    def finish(result, error):
+        result.error = error
+        result.elapsed = time.perf_counter() - result.started if result.started else 0.0
+        results.append(result)
+        if on_result:
+            on_result(result)
+
+    number = 0
+    for url, policy in jobs:
+        try:
+            entries = 0
+            for entry_url, _ in (expander.expand(url, str(policy)) if expander is not None else [(url, None)]):
+                entries += 1
+                number += 1
+                result = JobResult(entry_url, policy)
+                job_metrics = recorder.job(entry_url) if recorder is not None else None
+                bandwidth = None
+                if scheduler is not None:
+                    bandwidth = scheduler.share(priority=1 if audio_first and policy.kind == 'audio' else 0)
+                fetch = functools.partial(fetch_job, result, save_path, metadata_cache, refresh, library, job_metrics,
+                                          bandwidth, pipeline.cancel_event, streaming)
+                if number == profile_job:
+                    fetch = profiled(fetch, profile_out)
+                pending[pipeline.submit(fetch)] = result
+                # Report jobs that finished while the list was still being expanded
+                for future in [f for f in pending if f.done()]:
+                    finish(pending.pop(future), future.exception())
+            if not entries and collection_kind(url) is None:
+                result = JobResult(url, policy)
+                result.skipped = "same video and policy as an earlier line"
+                finish(result, None)
+        except Exception as e:
+            finish(JobResult(url, policy), e)
+
+    for future in as_completed(list(pending)):
+        finish(pending.pop(future), future.exception())
+    return results
+
+
+def format_summary(results, elapsed):
+    failed = [r for r in results if r.error is not None]
+    skipped = [r for r in results if r.skipped is not None]
+    total_bytes = sum(r.bytes_downloaded for r in results)
+    mb = total_bytes / (1024 * 1024)
+    lines = [
+        f"Jobs: {len(results)} total, {len(results) - len(failed) - len(skipped)} succeeded, "
+        f"{len(skipped)} skipped, {len(failed)} failed",
+        f"Downloaded: {mb:.1f} MB in {elapsed:.1f}s ({mb / elapsed if elapsed else 0:.2f} MB/s, "
+        f"{len(results) / elapsed * 60 if elapsed else 0:.1f} jobs/min)",
+    ]
+    for r in failed:
+        lines.append(f"  FAILED {r.url}: {r.error}")
+    return "\n".join(lines)
+
+
+def _print_result(result):
+    if result.skipped is not None:
+        print(f"[skipped] {result.url}: {result.skipped}")
+    elif result.error is None:
+        print(f"[ok]     {result.title} ({result.quality} {'/'.join(result.policy.file_formats)}) in {result.elapsed:.1f}s")
+    else:
+        print(f"[failed] {result.url}: {result.error}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Download many YouTube URLs without the GUI.")
+    parser.add_argument('input', help="File with one URL per line, or '-' for stdin")
+    parser.add_argument('-o', '--output', default='.', help="Folder to save downloads in")
+    parser.add_argument('-p', '--policy', default=DEFAULT_POLICY, help=f"Default format/quality policy (default: '{DEFAULT_POLICY}')")
+    parser.add_argument('-w', '--workers', type=int, default=4, help="Number of parallel downloads")
+    parser.add_argument('-t', '--transcode-workers', type=int, default=None, help="Number of parallel ffmpeg jobs (default: CPU cores)")
+    parser.add_argument('--refresh', action='store_true', help="Resolve every video again instead of using cached metadata")
+    parser.add_argument('--no-cache', action='store_true', help="Do not read or write the metadata cache")
+    parser.add_argument('--no-library', action='store_true', help="Download even if the library already has the file")
+    parser.add_argument('--expand-workers', type=int, default=DEFAULT_EXPAND_WORKERS,
+                        help=f"Parallel metadata lookups when expanding playlists and channels (default: {DEFAULT_EXPAND_WORKERS})")
+    parser.add_argument('--limit', type=parse_rate, metavar='RATE', help="Cap the combined download rate, e.g. 500K or 2M (bytes/s)")
+    parser.add_argument('--audio-first', action='store_true', help="With --limit, give audio-only jobs bandwidth before video jobs")
+    parser.add_argument('--stream', action='store_true', help="Pipe streams straight into ffmpeg instead of saving temp files first")
+    parser.add_argument('--metrics-jsonl', metavar='PATH', help="Append one JSON line per timed phase to PATH")
+    parser.add_argument('--metrics-prom', metavar='PATH', help="Write per-phase totals as a Prometheus textfile to PATH")
+    parser.add_argument('--profile-job', type=int, metavar='N', help="Run the download stage of the N-th job under cProfile")
+    parser.add_argument('--profile-out', default='job.prof', help="cProfile output file for --profile-job (default: job.prof)")
+    args = parser.parse_args(argv)
+
+    default_policy = Policy.parse(args.policy)
+    if args.input == '-':
+        jobs = read_jobs(sys.stdin, default_policy)
+    else:
+        with open(args.input, encoding='utf-8') as f:
+            jobs = read_jobs(f, default_policy)
+    os.makedirs(args.output, exist_ok=True)
+
+    started = time.perf_counter()
+    metadata_cache = None if args.no_cache else MetadataCache()
+    recorder = MetricsRecorder()
+    # Resolving entries ahead only pays off when the downloads can read the result from the cache
+    expander = PlaylistExpander(metadata_cache, workers=args.expand_workers,
+                                prefetch=metadata_cache is not None and not args.refresh)
+    try:
+        # Ctrl+C leaves the block early: queued jobs are dropped and running ones cancelled
+        with Pipeline(download_workers=max(1, args.workers), transcode_workers=args.transcode_workers) as pipeline:
+            results = run_batch(jobs, args.output, pipeline, on_result=_print_result,
+                                metadata_cache=metadata_cache, refresh=args.refresh,
+                                library=None if args.no_library else Library(),
+                                recorder=recorder, profile_job=args.profile_job, profile_out=args.profile_out,
+                                scheduler=BandwidthScheduler(args.limit) if args.limit else None,
+                                audio_first=args.audio_first, expander=expander, streaming=args.stream)
+    except KeyboardInterrupt:
+        print("Interrupted: the remaining jobs were cancelled; partial downloads can be resumed.")
+        return 130
+    print(format_summary(results, time.perf_counter() - started))
+    print(pipeline.format_stats())
+    print("Time by phase: " + ", ".join(f"{phase} {seconds:.1f}s" for phase, seconds in recorder.summary()))
+    if args.metrics_jsonl:
+        recorder.export_jsonl(args.metrics_jsonl)
+    if args.metrics_prom:
+        recorder.export_prometheus(args.metrics_prom)
+    return 1 if any(r.error is not None for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
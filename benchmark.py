@@ -0,0 +1,852 @@
+"""
+Offline benchmarks for the downloader core.
+
+A local HTTP server stands in for YouTube's media servers, serving synthetic
+bytes or real clips generated with the local ffmpeg, with a per-connection
+throttle and Range support, so the numbers are reproducible and do not
+depend on the network. The metadata and end_to_end benchmarks also swap
+pytubefix for a fake backend (see FakeYouTubeBackend), so YouTubeDownloader
+runs its real code from get_video_info to the finished file.
+
+A run can be saved as a JSON report tagged with the git revision and
+compared with the report of another commit.
+
+Usage:
+    python benchmark.py [adaptive] [segmented] [ui_queue] [startup] [thumbnails] [bandwidth] [playlist]
+                        [metadata] [end_to_end] [ffmpeg_control]
+    python benchmark.py --report before.json
+    python benchmark.py --report after.json --compare before.json
+"""
+import argparse
+import functools
+import json
+import os
+import platform
+import queue
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from io import BytesIO
+
+from bandwidth import BandwidthScheduler
+from cache import MetadataCache
+from downloader import NO_WINDOW, DownloadCancelled, YouTubeDownloader
+from metrics import MetricsRecorder
+from utils import ProgressAggregator
+
+MB = 1024 * 1024
+
+# Cold-start import budgets in seconds (median of several runs), and the
+# modules each entry point must not pull in at import time
+STARTUP_BUDGETS = {'downloader': 0.15, 'batch': 0.25, 'main': 0.6}
+STARTUP_FORBIDDEN = {
+    'downloader': ('pytubefix', 'tkinter', 'PIL', 'requests'),
+    'batch': ('pytubefix', 'tkinter', 'PIL', 'requests'),
+    'main': ('pytubefix', 'PIL', 'requests'),
+}
+
+
+class _MediaHandler(BaseHTTPRequestHandler):
+    """
+    Serves `/<size>` as `size` synthetic bytes, or `/files/<name>` from the
+    server's registered files, throttled per connection, with Range support.
+    Speaks HTTP/1.1 so clients can keep connections alive, like a CDN would.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_HEAD(self):
+        self.do_GET(head_only=True)
+
+    def do_GET(self, head_only=False):
+        path = self.path.split('?')[0]
+        data = None
+        if path.startswith('/files/'):
+            data = self.server.files[path[len('/files/'):]]
+            size = len(data)
+        else:
+            size = int(path.strip('/'))
+        start, end = 0, size - 1
+        range_header = self.headers.get('Range')
+        if range_header and self.server.ranges:
+            first, _, last = range_header.replace('bytes=', '').partition('-')
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if not head_only:
+            self._send_bytes(start, end - start + 1, data)
+
+    def _send_bytes(self, start, count, data=None):
+        rate = self.server.bytes_per_second
+        block = 64 * 1024
+        zeros = b'\0' * block
+        sent = 0
+        started = time.perf_counter()
+        while sent < count:
+            n = min(block, count - sent)
+            try:
+                self.wfile.write(zeros[:n] if data is None else data[start + sent:start + sent + n])
+            except ConnectionError:
+                self.close_connection = True
+                return  # client cancelled or fell back to another request
+            sent += n
+            if rate:
+                ahead = sent / rate - (time.perf_counter() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # Clients drop kept-alive connections when they cancel or finish; that is not an error here
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class LocalMediaServer:
+    """A throttled local HTTP server run on a background thread."""
+    def __init__(self, bytes_per_second=None, ranges=True):
+        self.httpd = _QuietHTTPServer(('127.0.0.1', 0), _MediaHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.bytes_per_second = bytes_per_second
+        self.httpd.ranges = ranges
+        self.httpd.files = {}
+        self.httpd.lock = threading.Lock()
+        self.httpd.connections = 0
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def url_for(self, size):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}/{size}"
+
+    def add_file(self, name, data):
+        """Serves `data` at the returned URL."""
+        self.httpd.files[name] = data
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}/files/{name}"
+
+    @property
+    def connections(self):
+        """TCP connections accepted so far."""
+        return self.httpd.connections
+
+
+class FakeStream:
+    """The subset of a pytubefix Stream the downloader needs for a transfer."""
+    def __init__(self, url, filesize, itag=0):
+        self.url = url
+        self.filesize = filesize
+        self.itag = itag
+
+
+# --- Fake YouTube backend ---
+
+def make_clips(directory, seconds=10, height=720):
+    """
+    Generates test media with the local ffmpeg, laid out like YouTube's (index
+    before the media data): a 360p progressive H.264/AAC mp4, a video-only
+    H.264 mp4 at `height` and an audio-only AAC m4a. Returns their bytes as
+    {'progressive', 'video', 'audio'}.
+    """
+    source = ['-f', 'lavfi', '-i', f"testsrc2=size={height * 16 // 9}x{height}:rate=30:duration={seconds}",
+              '-f', 'lavfi', '-i', f"sine=frequency=440:duration={seconds}"]
+    video = ['-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p']
+    audio = ['-c:a', 'aac', '-b:a', '128k']
+    layouts = {
+        'progressive': ['-map', '0:v', '-map', '1:a', '-vf', 'scale=-2:360', *video, *audio],
+        'video': ['-map', '0:v', *video],
+        'audio': ['-map', '1:a', *audio],
+    }
+    clips = {}
+    for name, args in layouts.items():
+        path = os.path.join(directory, f"{name}.mp4")
+        subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', *source, *args, '-movflags', '+faststart', path],
+                       check=True, creationflags=NO_WINDOW)
+        with open(path, 'rb') as f:
+            clips[name] = f.read()
+    return clips
+
+
+class FakeYouTubeStream:
+    """The attributes of a pytubefix Stream read by the stream catalog, the metadata cache and the engine."""
+    def __init__(self, itag, url, mime_type, filesize, resolution=None, abr=None, is_progressive=False,
+                 video_codec=None, audio_codec=None):
+        self.itag = itag
+        self.url = url
+        self.mime_type = mime_type
+        self.resolution = resolution
+        self.abr = abr
+        self.is_progressive = is_progressive
+        self.video_codec = video_codec
+        self.audio_codec = audio_codec
+        self._filesize = filesize
+
+    @property
+    def filesize(self):
+        return self._filesize
+
+
+def _fake_video_id(url):
+    # The same pattern pytubefix.extract.video_id uses
+    return re.search(r"(?:v=|/)([0-9A-Za-z_-]{11})", url).group(1)
+
+
+class _FakeYouTube:
+    """Stands in for pytubefix.YouTube; resolving a video sleeps like the watch page and player requests would."""
+    def __init__(self, backend, url, on_progress_callback=None, **kwargs):
+        time.sleep(backend.resolve_delay)
+        with backend.lock:
+            backend.resolutions += 1
+        video = backend.videos[_fake_video_id(url)]
+        self.title = video['title']
+        self.thumbnail_url = video['thumbnail_url']
+        self.streams = video['streams']
+
+
+class FakeYouTubeBackend:
+    """
+    Installs a stand-in `pytubefix` module (YouTube and extract.video_id) in
+    sys.modules for the duration of a `with` block. Videos registered with
+    add_video are served from a LocalMediaServer, so the downloader's own
+    metadata, transfer and ffmpeg code runs unchanged.
+    """
+    def __init__(self, server, resolve_delay=0.3):
+        self.server = server
+        self.resolve_delay = resolve_delay
+        self.videos = {}
+        self.resolutions = 0
+        self.lock = threading.Lock()
+        self._saved = {}
+
+    def add_video(self, video_id, title, clips, height=720):
+        """Registers a video whose streams serve `clips` (see make_clips). Returns its watch URL."""
+        # Signed URLs carry their expiry, like the real ones
+        expire = f"?expire={int(time.time()) + 6 * 60 * 60}"
+        urls = {name: self.server.add_file(f"{video_id}_{name}.mp4", data) + expire for name, data in clips.items()}
+        self.videos[video_id] = {
+            'title': title,
+            'thumbnail_url': self.server.url_for(1024),
+            'streams': [
+                FakeYouTubeStream(18, urls['progressive'], 'video/mp4', len(clips['progressive']), resolution='360p',
+                                  is_progressive=True, video_codec='avc1.42001E', audio_codec='mp4a.40.2'),
+                FakeYouTubeStream(136, urls['video'], 'video/mp4', len(clips['video']), resolution=f"{height}p",
+                                  video_codec='avc1.4d401f'),
+                FakeYouTubeStream(140, urls['audio'], 'audio/mp4', len(clips['audio']), abr='128kbps',
+                                  audio_codec='mp4a.40.2'),
+            ],
+        }
+        return f"https://www.youtube.com/watch?v={video_id}"
+
+    def __enter__(self):
+        module = types.ModuleType('pytubefix')
+        extract = types.ModuleType('pytubefix.extract')
+        extract.video_id = _fake_video_id
+        module.extract = extract
+        module.YouTube = functools.partial(_FakeYouTube, self)
+        for name, fake in (('pytubefix', module), ('pytubefix.extract', extract)):
+            self._saved[name] = sys.modules.get(name)
+            sys.modules[name] = fake
+        return self
+
+    def __exit__(self, *exc):
+        for name, original in self._saved.items():
+            if original is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = original
+
+
+def bench_adaptive(video_size=24 * MB, audio_size=6 * MB, rate=8 * MB):
+    """Compares fetching an adaptive video+audio pair one after the other vs. concurrently."""
+    downloader = YouTubeDownloader(segments=1)
+    with LocalMediaServer(bytes_per_second=rate) as server, tempfile.TemporaryDirectory() as tmp:
+        video = FakeStream(server.url_for(video_size), video_size)
+        audio = FakeStream(server.url_for(audio_size), audio_size)
+        video_path = os.path.join(tmp, 'bench_vid.mp4')
+        audio_path = os.path.join(tmp, 'bench_aud.mp4')
+
+        started = time.perf_counter()
+        downloader._download_stream(video, video_path)
+        video_only = time.perf_counter() - started
+        downloader._download_stream(audio, audio_path)
+        sequential = time.perf_counter() - started
+        audio_only = sequential - video_only
+
+        started = time.perf_counter()
+        downloader._download_concurrently([(video, video_path), (audio, audio_path)])
+        concurrent = time.perf_counter() - started
+
+        assert os.path.getsize(video_path) == video_size
+        assert os.path.getsize(audio_path) == audio_size
+
+    print(f"adaptive: sequential {sequential:.2f}s, concurrent {concurrent:.2f}s, "
+          f"speedup x{sequential / concurrent:.2f}")
+    # The audio should be hidden behind the video transfer; allow half of its own time as slack
+    assert concurrent <= video_only + audio_only / 2, "the audio was not fetched alongside the video"
+    return {'sequential_s': sequential, 'concurrent_s': concurrent}
+
+
+def bench_segmented(size=32 * MB, rate=8 * MB, segments=(1, 2, 4, 8)):
+    """Measures single-stream throughput for different numbers of byte ranges fetched in parallel."""
+    results = {}
+    with LocalMediaServer(bytes_per_second=rate) as server, tempfile.TemporaryDirectory() as tmp:
+        stream = FakeStream(server.url_for(size), size)
+        path = os.path.join(tmp, 'bench_temp.mp4')
+        for count in segments:
+            downloader = YouTubeDownloader(segments=count)
+            started = time.perf_counter()
+            downloader._download_stream(stream, path)
+            elapsed = time.perf_counter() - started
+            assert os.path.getsize(path) == size
+            results[count] = elapsed
+            print(f"segmented: {count} parallel range(s) {elapsed:.2f}s, {size / MB / elapsed:.1f} MB/s")
+    return results
+
+
+class _StandInWidget:
+    """Replaces a Tk widget when no display is available; counts config calls."""
+    def __init__(self):
+        self.calls = 0
+        self.options = {}
+
+    def config(self, **options):
+        self.calls += 1
+        self.options.update(options)
+
+    def __setitem__(self, key, value):
+        self.config(**{key: value})
+
+
+def _ui_widgets():
+    """A real Tk label and progress bar if a display is available, stand-ins otherwise."""
+    try:
+        import tkinter as tk
+        from tkinter import ttk
+        root = tk.Tk()
+        root.withdraw()
+        return root, ttk.Label(root), ttk.Progressbar(root)
+    except Exception:
+        return None, _StandInWidget(), _StandInWidget()
+
+
+def bench_ui_queue(size=1024 * MB, rate=50 * MB, chunk_size=64 * 1024):
+    """
+    UI-thread time per downloaded GB: per-chunk queue messages drained by a
+    100 ms poll (the old App pump) vs. the coalescing ProgressAggregator.
+    The download is simulated on a virtual clock so the run takes seconds, not minutes.
+    """
+    chunks = size // chunk_size
+    chunk_time = chunk_size / rate
+    results = {}
+    root, label, bar = _ui_widgets()
+
+    # --- Before: two messages per chunk, drained every 100 ms ---
+    ui_queue = queue.Queue()
+    ui_time, next_poll = 0.0, 0.1
+    for i in range(1, chunks + 1):
+        percentage = i / chunks * 100
+        ui_queue.put(("update_progress", percentage))
+        ui_queue.put(("update_status", f"Downloading... {int(percentage)}%"))
+        if i * chunk_time >= next_poll or i == chunks:
+            next_poll += 0.1
+            started = time.perf_counter()
+            while not ui_queue.empty():
+                command, value = ui_queue.get_nowait()
+                if command == "update_progress":
+                    bar['value'] = value
+                else:
+                    label.config(text=value)
+            ui_time += time.perf_counter() - started
+    results['before_ms_per_gb'] = ui_time * 1000 / (size / (1024 * MB))
+
+    # --- After: latest state only, published at most every 100 ms ---
+    clock = [0.0]
+    ui_queue = queue.Queue()
+    aggregator = ProgressAggregator(lambda job_id: ui_queue.put(("show_progress", job_id)), clock=lambda: clock[0])
+    ui_time = 0.0
+    for i in range(1, chunks + 1):
+        clock[0] = i * chunk_time
+        aggregator.update('download', i * chunk_size, size)
+        if not ui_queue.empty():
+            started = time.perf_counter()
+            while not ui_queue.empty():
+                _, job_id = ui_queue.get_nowait()
+                snapshot = aggregator.snapshot(job_id)
+                bar['value'] = snapshot['percentage']
+                label.config(text=f"Downloading... {int(snapshot['percentage'])}%")
+            ui_time += time.perf_counter() - started
+    results['after_ms_per_gb'] = ui_time * 1000 / (size / (1024 * MB))
+
+    if root is not None:
+        root.destroy()
+    widget = "Tk" if root is not None else "stand-in"
+    print(f"ui_queue ({widget} widgets): before {results['before_ms_per_gb']:.1f} ms/GB, "
+          f"after {results['after_ms_per_gb']:.1f} ms/GB of UI-thread time")
+    return results
+
+
+def _import_profile(module):
+    """
+    Imports `module` in a fresh interpreter with -X importtime. Returns its
+    cumulative import time in seconds and the names of every module loaded.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    cumulative, loaded = None, set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, total, name = line.split('|')
+        loaded.add(name.strip())
+        # Nested imports are indented under their importer; the module itself is at the top level
+        if name == f" {module}":
+            cumulative = int(total) / 1e6
+    return cumulative, loaded
+
+
+def bench_startup(runs=5):
+    """
+    Cold-start import time of each entry point, -X importtime style. Fails if
+    a module goes over its budget or imports something it should defer.
+    """
+    results, failures = {}, []
+    for module, budget in STARTUP_BUDGETS.items():
+        try:
+            profiles = [_import_profile(module) for _ in range(runs)]
+        except RuntimeError as e:
+            print(f"startup: {module} skipped ({e})")
+            continue
+        median = statistics.median(cumulative for cumulative, _ in profiles)
+        leaked = sorted(name for name in STARTUP_FORBIDDEN[module]
+                        if any(loaded == name or loaded.startswith(name + '.') for loaded in profiles[0][1]))
+        results[module] = median
+        print(f"startup: import {module} {median * 1000:.0f} ms (budget {budget * 1000:.0f} ms)"
+              + (f", eagerly imports {', '.join(leaked)}" if leaked else ""))
+        if median > budget:
+            failures.append(f"{module} took {median * 1000:.0f} ms, over its {budget * 1000:.0f} ms budget")
+        if leaked:
+            failures.append(f"{module} imports {', '.join(leaked)} at startup")
+    assert not failures, "startup regression: " + "; ".join(failures)
+    return results
+
+
+def bench_thumbnails(count=20, rate=4 * MB):
+    """
+    Thumbnails for `count` videos: a new connection and a full decode per fetch
+    (the old display_thumbnail) vs. the ThumbnailCache cold (pooled session),
+    warm from disk and warm in memory.
+    """
+    import requests
+    from PIL import Image
+    from cache import THUMBNAIL_SIZE, ThumbnailCache
+
+    buffer = BytesIO()
+    Image.effect_noise((1280, 720), 64).convert('RGB').save(buffer, 'JPEG', quality=90)
+    results = {}
+    with LocalMediaServer(bytes_per_second=rate) as server, tempfile.TemporaryDirectory() as tmp:
+        urls = [server.add_file(f"thumb{i}.jpg", buffer.getvalue()) for i in range(count)]
+
+        connections = server.connections
+        started = time.perf_counter()
+        for url in urls:
+            response = requests.get(url, stream=True)
+            image = Image.open(BytesIO(response.content))
+            image.thumbnail(THUMBNAIL_SIZE)
+        results['uncached_s'] = time.perf_counter() - started
+        results['uncached_connections'] = server.connections - connections
+
+        cache = ThumbnailCache(cache_dir=tmp)
+        connections = server.connections
+        started = time.perf_counter()
+        for i, url in enumerate(urls):
+            cache.get(f"video{i}", url)
+        results['cold_s'] = time.perf_counter() - started
+        results['cold_connections'] = server.connections - connections
+
+        # A new cache over the same folder, as after restarting the app
+        cache = ThumbnailCache(cache_dir=tmp)
+        for label in ('disk_s', 'memory_s'):
+            started = time.perf_counter()
+            for i, url in enumerate(urls):
+                cache.get(f"video{i}", url)
+            results[label] = time.perf_counter() - started
+        assert cache.hits == {'memory': count, 'disk': count, 'network': 0}, cache.hits
+
+    print(f"thumbnails ({count}): uncached {results['uncached_s'] * 1000:.0f} ms over "
+          f"{results['uncached_connections']} connections, cold cache {results['cold_s'] * 1000:.0f} ms over "
+          f"{results['cold_connections']}, disk {results['disk_s'] * 1000:.1f} ms, "
+          f"memory {results['memory_s'] * 1000:.2f} ms")
+    return results
+
+
+def bench_bandwidth(size=64 * MB, limit=8 * MB, phase_seconds=1.5):
+    """
+    Two concurrent downloads from an unthrottled server under one scheduler:
+    checks the combined rate holds the limit, that weights 1:3 split it 1:3,
+    that a live re-tune to twice the limit takes effect, and that a higher
+    priority takes the bandwidth. Rates are measured from the progress
+    callbacks, i.e. what the UI would show.
+    """
+    scheduler = BandwidthScheduler(limit)
+    shares = [scheduler.share(weight=1), scheduler.share(weight=3)]
+    received = [0, 0]
+
+    def counter(index):
+        def on_progress(stream, chunk, bytes_remaining):
+            received[index] += len(chunk)
+        return on_progress
+
+    def measure():
+        before, started = list(received), time.perf_counter()
+        time.sleep(phase_seconds)
+        elapsed = time.perf_counter() - started
+        return [(after - b) / elapsed for after, b in zip(received, before)]
+
+    results = {}
+    with LocalMediaServer() as server, tempfile.TemporaryDirectory() as tmp:
+        threads = []
+        for index, share in enumerate(shares):
+            downloader = YouTubeDownloader(bandwidth=share)
+            stream = FakeStream(server.url_for(size), size)
+            threads.append(threading.Thread(target=downloader._download_stream,
+                                            args=(stream, os.path.join(tmp, f"bench_{index}.mp4"), counter(index))))
+        for thread in threads:
+            thread.start()
+        time.sleep(0.5)  # let the bucket settle
+
+        results['weighted'] = measure()
+        scheduler.set_rate(2 * limit)
+        results['retuned'] = measure()
+        shares[0].retune(priority=1)
+        results['prioritised'] = measure()
+        scheduler.set_rate(None)
+        for thread in threads:
+            thread.join()
+
+    for phase, rates in results.items():
+        print(f"bandwidth {phase}: job A {rates[0] / MB:.2f} MB/s, job B {rates[1] / MB:.2f} MB/s, "
+              f"total {sum(rates) / MB:.2f} MB/s")
+    weighted, retuned, prioritised = results['weighted'], results['retuned'], results['prioritised']
+    assert abs(sum(weighted) - limit) < 0.15 * limit, "combined rate does not hold the limit"
+    assert 2.2 < weighted[1] / weighted[0] < 3.8, "weights 1:3 are not respected"
+    assert abs(sum(retuned) - 2 * limit) < 0.15 * 2 * limit, "re-tuned limit did not take effect"
+    assert prioritised[0] > 0.85 * sum(prioritised), "higher priority did not take the bandwidth"
+    return results
+
+
+class _StubPlaylist:
+    """Stands in for pytubefix's Playlist: `video_urls` pages in with a delay per page, like the real listing."""
+    def __init__(self, title, ids, page_size, page_delay):
+        self.title = title
+        self._ids = ids
+        self._page_size = page_size
+        self._page_delay = page_delay
+
+    @property
+    def video_urls(self):
+        for index, video_id in enumerate(self._ids):
+            if index % self._page_size == 0:
+                time.sleep(self._page_delay)
+            yield f"https://youtu.be/{video_id}"
+
+
+def bench_playlist(entries=60, duplicates=12, page_size=20, page_delay=0.1, resolve_delay=0.05, workers=(1, 8)):
+    """
+    Expands a stub playlist of `entries` videos, `duplicates` of them listed
+    twice, with metadata resolution taking `resolve_delay` per video: time to
+    the first resolved entry and to the whole list, serially vs. on a pool.
+    Runs offline; no pytubefix object is built.
+    """
+    from playlist import PlaylistExpander
+
+    ids = [f"video{i:06d}" for i in range(entries)]
+    ids += ids[:duplicates]
+
+    def resolve(url):
+        time.sleep(resolve_delay)
+        return {'title': url, 'video_resolutions': ['360p'], 'audio_bitrates': ['128kbps']}
+
+    results = {}
+    for count in workers:
+        expander = PlaylistExpander(workers=count, resolve=resolve,
+                                    open_collection=lambda url: _StubPlaylist("Stub", ids, page_size, page_delay))
+        started = time.perf_counter()
+        first = None
+        seen = []
+        for url, info in expander.expand("https://www.youtube.com/playlist?list=PLstub"):
+            first = first or time.perf_counter() - started
+            assert info is not None and info['title'] == url
+            seen.append(url)
+        total = time.perf_counter() - started
+        assert len(seen) == len(set(seen)) == entries, f"expected {entries} unique entries, got {len(seen)}"
+        results[count] = {'first_s': first, 'total_s': total}
+        print(f"playlist ({entries} videos + {duplicates} duplicates), {count} workers: "
+              f"first entry after {first * 1000:.0f} ms, all after {total:.2f}s")
+
+    serial, pooled = results[workers[0]], results[workers[-1]]
+    pages = -(-len(ids) // page_size)
+    assert pooled['first_s'] < pages * page_delay, "entries are not handed out before the listing finishes"
+    assert pooled['total_s'] < serial['total_s'] / 3, "parallel resolution is not faster than serial"
+    return results
+
+
+def bench_metadata(resolve_delay=0.3, runs=5):
+    """
+    get_video_info latency against the fake backend: resolving the video
+    (a pytubefix object per call) vs. answering from the metadata cache.
+    """
+    clips = {'progressive': b'\0' * 1024, 'video': b'\0' * 1024, 'audio': b'\0' * 1024}
+    results = {}
+    with LocalMediaServer() as server, FakeYouTubeBackend(server, resolve_delay) as backend, \
+            tempfile.TemporaryDirectory() as tmp:
+        url = backend.add_video('benchmeta01', "Metadata benchmark", clips)
+        cache = MetadataCache(cache_dir=tmp)
+        for label, metadata_cache, refresh in (('resolve', None, False), ('resolve_and_cache', cache, True),
+                                               ('cache_hit', cache, False)):
+            timings = []
+            for _ in range(runs):
+                started = time.perf_counter()
+                info = YouTubeDownloader(metadata_cache=metadata_cache).get_video_info(url, refresh=refresh)
+                timings.append(time.perf_counter() - started)
+                assert info['video_resolutions'] == ['720p', '360p'], info
+            results[f"{label}_ms"] = statistics.median(timings) * 1000
+        assert backend.resolutions == 2 * runs, "cache hits still resolved the video"
+
+    print(f"metadata: resolve {results['resolve_ms']:.0f} ms, resolve and cache {results['resolve_and_cache_ms']:.0f} ms, "
+          f"cache hit {results['cache_hit_ms']:.1f} ms")
+    return results
+
+
+def _phase_summary(job_metrics, wall):
+    """Seconds per phase of one job, plus the transfer throughput over the window its transfers ran in."""
+    summary = {'wall_s': wall}
+    for s in job_metrics.spans:
+        summary[f"{s.phase}_s"] = summary.get(f"{s.phase}_s", 0.0) + s.duration
+        if s.cpu_time is not None:
+            summary[f"{s.phase}_cpu_s"] = summary.get(f"{s.phase}_cpu_s", 0.0) + s.cpu_time
+    # Adaptive halves transfer side by side, so their durations cannot simply be added up
+    transfers = [s for s in job_metrics.spans if s.phase in ('transfer', 'stream_ffmpeg') and s.bytes]
+    if transfers:
+        window = max(s.started_at + s.duration for s in transfers) - min(s.started_at for s in transfers)
+        summary['transfer_mb_per_sec'] = sum(s.bytes for s in transfers) / MB / window if window else None
+    return summary
+
+
+def bench_end_to_end(seconds=20, height=720, rate=16 * MB, resolve_delay=0.3):
+    """
+    Whole jobs through the fake backend and the local ffmpeg, each in
+    temp-file and in streaming mode: metadata, transfer and ffmpeg time per
+    job, and transfer throughput, taken from the jobs' own timing spans.
+    """
+    scenarios = [
+        ('progressive_mp4', 'video', '360p', ['mp4']),
+        ('progressive_to_mkv', 'video', '360p', ['mkv']),
+        ('adaptive_merge_mp4', 'video', f"{height}p", ['mp4']),
+        ('adaptive_merge_3_formats', 'video', f"{height}p", ['mp4', 'mkv', 'avi']),
+        ('audio_to_mp3', 'audio', '128kbps', ['mp3']),
+    ]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp, LocalMediaServer(bytes_per_second=rate) as server, \
+            FakeYouTubeBackend(server, resolve_delay) as backend:
+        clips = make_clips(tmp, seconds, height)
+        print(f"end_to_end: {seconds}s clips, progressive {len(clips['progressive']) / MB:.1f} MB, "
+              f"video {len(clips['video']) / MB:.1f} MB, audio {len(clips['audio']) / MB:.1f} MB")
+        cache = MetadataCache(os.path.join(tmp, 'metadata'))
+        recorder = MetricsRecorder()
+        for streaming in (False, True):
+            for label, kind, quality, formats in scenarios:
+                name = f"{label}.{'streaming' if streaming else 'temp_file'}"
+                # A new video per job, so neither the metadata cache nor the library can short-cut it
+                url = backend.add_video(f"e2e{len(results):08d}", name, clips, height)
+                save_path = os.path.join(tmp, name)
+                os.makedirs(save_path)
+                job_metrics = recorder.job(name)
+                downloader = YouTubeDownloader(streaming=streaming, metadata_cache=cache, job_metrics=job_metrics)
+                started = time.perf_counter()
+                downloader.get_video_info(url)
+                if kind == 'audio':
+                    downloader.download_audio(save_path, quality, formats)
+                else:
+                    downloader.download_video(save_path, quality, formats)
+                wall = time.perf_counter() - started
+
+                outputs = sorted(os.listdir(save_path))
+                assert [path.rsplit('.', 1)[1] for path in outputs] == sorted(formats), outputs
+                assert all(os.path.getsize(os.path.join(save_path, path)) for path in outputs), outputs
+                results[name] = _phase_summary(job_metrics, wall)
+                phases = ", ".join(f"{key[:-2]} {value:.2f}s" for key, value in results[name].items()
+                                   if key.endswith('_s') and key != 'wall_s')
+                rate_text = f", {results[name]['transfer_mb_per_sec']:.1f} MB/s" if results[name].get('transfer_mb_per_sec') else ""
+                print(f"end_to_end {name}: {wall:.2f}s ({phases}{rate_text})")
+    return results
+
+
+def bench_ffmpeg_control(seconds=30, height=720, cancel_after=1.0):
+    """
+    A managed ffmpeg transcode (mp4 to AVI, a full re-encode): how often
+    progress events arrive, and how long a cancel takes to kill ffmpeg and
+    clean up its temp input and partial output.
+    """
+    from downloader import _filenames
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        clip = make_clips(tmp, seconds, height)['progressive']
+        events = []
+        downloader = YouTubeDownloader(transcode_callback=events.append)
+        for label in ('complete', 'cancelled'):
+            input_file = os.path.join(tmp, f"{label}_temp.mp4")
+            with open(input_file, 'wb') as f:
+                f.write(clip)
+            output_file = _filenames.reserve(os.path.join(tmp, f"{label}.avi"))
+            events.clear()
+            if label == 'cancelled':
+                downloader.begin_job()
+                threading.Timer(cancel_after, downloader.cancel).start()
+            started = time.perf_counter()
+            try:
+                downloader._run_ffmpeg_conversion(input_file, [output_file])
+            except DownloadCancelled:
+                results['cancel_latency_ms'] = (time.perf_counter() - started - cancel_after) * 1000
+                assert not os.path.exists(output_file), "a cancelled run left its partial output"
+            else:
+                results['transcode_s'] = time.perf_counter() - started
+                results['progress_events'] = len(events)
+                assert events and events[-1]['done'] and events[-1]['percentage'] == 100.0, events[-1:]
+                percentages = [e['percentage'] for e in events if e['percentage'] is not None]
+                assert percentages == sorted(percentages), "progress went backwards"
+            assert not os.path.exists(input_file), "the temp input was not removed"
+        assert 'cancel_latency_ms' in results, "the transcode finished before it could be cancelled"
+
+    print(f"ffmpeg_control: transcode {results['transcode_s']:.2f}s with {results['progress_events']} progress "
+          f"events, cancel took {results['cancel_latency_ms']:.0f} ms")
+    return results
+
+
+BENCHMARKS = {
+    'adaptive': bench_adaptive,
+    'segmented': bench_segmented,
+    'ui_queue': bench_ui_queue,
+    'startup': bench_startup,
+    'thumbnails': bench_thumbnails,
+    'bandwidth': bench_bandwidth,
+    'playlist': bench_playlist,
+    'metadata': bench_metadata,
+    'end_to_end': bench_end_to_end,
+    'ffmpeg_control': bench_ffmpeg_control,
+}
+
+
+# --- Reports ---
+
+def _git_revision():
+    """The short commit hash of this tree, with -dirty if tracked files are modified; None outside a git checkout."""
+    root = os.path.dirname(os.path.abspath(__file__))
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root, capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{revision}-dirty" if dirty else revision
+
+
+def _numbers(value, prefix=''):
+    """Flattens benchmark results into {'benchmark.key.subkey': number}."""
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, (list, tuple)):
+        items = enumerate(value)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix: value}
+    else:
+        return {}
+    numbers = {}
+    for key, item in items:
+        numbers.update(_numbers(item, f"{prefix}.{key}" if prefix else str(key)))
+    return numbers
+
+
+def build_report(results, errors):
+    report = {
+        'revision': _git_revision(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+        'errors': errors,
+    }
+    # Round-trip through JSON, so a fresh report compares like one read back from disk
+    return json.loads(json.dumps(report, default=str))
+
+
+def compare_reports(old, new):
+    """One line per figure present in both reports, with its relative change."""
+    before, after = _numbers(old['results']), _numbers(new['results'])
+    lines = [f"Compared with {old.get('revision') or 'an unknown revision'} ({old.get('created_at', '?')}):"]
+    for key in sorted(before.keys() & after.keys()):
+        change = f"{(after[key] - before[key]) / before[key]:+.1%}" if before[key] else "n/a"
+        lines.append(f"  {key}: {before[key]:.4g} -> {after[key]:.4g} ({change})")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the offline benchmarks.")
+    parser.add_argument('names', nargs='*', metavar='NAME', help=f"Benchmarks to run (default: all of {', '.join(BENCHMARKS)})")
+    parser.add_argument('--report', metavar='PATH', help="Write the results as JSON, tagged with the git revision")
+    parser.add_argument('--compare', metavar='PATH', help="Print the change of every figure against an earlier report")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    results, errors = {}, {}
+    for name in args.names or list(BENCHMARKS):
+        try:
+            results[name] = BENCHMARKS[name]()
+        except AssertionError as e:
+            print(f"{name}: FAILED {e}")
+            errors[name] = str(e)
+
+    report = build_report(results, errors)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            print(compare_reports(json.load(f), report))
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
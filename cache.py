@@ -0,0 +1,167 @@
+"""
+On-disk caches of video metadata and thumbnails, so repeated "Check" clicks
+and batch re-runs do not resolve or download the same video's details again.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+
+from utils import HTTP_TIMEOUT, app_data_dir, http_session
+
+# Metadata older than this is resolved again
+DEFAULT_TTL = 60 * 60
+# Least recently used entries beyond this count are evicted
+DEFAULT_MAX_ENTRIES = 500
+# Bounding box thumbnails are resized to, matching the GUI's thumbnail label
+THUMBNAIL_SIZE = (240, 135)
+# Resized thumbnails kept decoded in memory, and on disk
+DEFAULT_MEMORY_THUMBNAILS = 64
+DEFAULT_MAX_THUMBNAILS = 2000
+
+
+def _evict_oldest(directory, suffix, max_entries):
+    """Deletes the least recently used files ending in `suffix` beyond `max_entries`, by modification time."""
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith(suffix):
+            path = os.path.join(directory, name)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+    if len(entries) <= max_entries:
+        return
+    entries.sort()
+    for _, path in entries[:len(entries) - max_entries]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class MetadataCache:
+    """
+    Stores one JSON file per video ID. A file's modification time doubles as
+    its last-used time, so touching it on every hit gives LRU eviction
+    without a separate index.
+    """
+    def __init__(self, cache_dir=None, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.cache_dir = cache_dir or app_data_dir('metadata')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def _path(self, video_id):
+        return os.path.join(self.cache_dir, f"{video_id}.json")
+
+    def get(self, video_id):
+        """Returns the cached entry for `video_id`, or None if it is missing or older than the TTL."""
+        path = self._path(video_id)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - entry.get('fetched_at', 0) > self.ttl:
+            self.invalidate(video_id)
+            return None
+
+        try:
+            os.utime(path)  # mark as recently used
+        except OSError:
+            pass
+        return entry
+
+    def put(self, video_id, entry):
+        entry = dict(entry, fetched_at=time.time())
+        path = self._path(video_id)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with self._lock:
+            # Write then rename, so readers never see a half-written file
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(temp_path, path)
+            _evict_oldest(self.cache_dir, '.json', self.max_entries)
+
+    def invalidate(self, video_id):
+        try:
+            os.remove(self._path(video_id))
+        except OSError:
+            pass
+
+
+class ThumbnailCache:
+    """
+    Two-level cache of resized thumbnails keyed by video ID: an in-memory LRU
+    of decoded PIL images in front of one small JPEG per video on disk. Only a
+    miss on both levels goes to the network, and the full-size image is then
+    decoded and resized once. PIL is imported on first use.
+    """
+    def __init__(self, cache_dir=None, memory_entries=DEFAULT_MEMORY_THUMBNAILS, max_entries=DEFAULT_MAX_THUMBNAILS):
+        self.cache_dir = cache_dir or app_data_dir('thumbnails')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.memory_entries = memory_entries
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        # Where each get() was answered from, for benchmarks and metrics
+        self.hits = {'memory': 0, 'disk': 0, 'network': 0}
+
+    def _path(self, video_id):
+        return os.path.join(self.cache_dir, f"{video_id}.jpg")
+
+    def _remember(self, video_id, image, source):
+        with self._lock:
+            self._memory[video_id] = image
+            self._memory.move_to_end(video_id)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+            self.hits[source] += 1
+
+    def get(self, video_id, url=None):
+        """
+        Returns the resized thumbnail of `video_id` as a PIL image. On a miss it
+        is downloaded from `url`; without a URL a miss returns None.
+        """
+        from PIL import Image
+
+        with self._lock:
+            image = self._memory.get(video_id)
+            if image is not None:
+                self._memory.move_to_end(video_id)
+                self.hits['memory'] += 1
+                return image
+
+        path = self._path(video_id)
+        try:
+            with Image.open(path) as cached:
+                image = cached.copy()
+            os.utime(path)  # mark as recently used
+        except (OSError, ValueError):
+            image = None
+        if image is not None:
+            self._remember(video_id, image, 'disk')
+            return image
+
+        if url is None:
+            return None
+        response = http_session().get(url, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        with Image.open(BytesIO(response.content)) as full_size:
+            full_size.thumbnail(THUMBNAIL_SIZE)
+            image = full_size.convert('RGB')
+
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            image.save(temp_path, 'JPEG', quality=90)
+            os.replace(temp_path, path)
+            _evict_oldest(self.cache_dir, '.jpg', self.max_entries)
+        except OSError as e:
+            print(f"Could not cache thumbnail: {e}")
+        self._remember(video_id, image, 'network')
+        return image
@@ -0,0 +1,506 @@
+"""
+Local download daemon: one long-running engine that several GUIs and
+scripts on the same machine submit jobs to, so they share its worker
+pools, bandwidth limit, HTTP connections and warm metadata.
+
+It speaks JSON over HTTP on the loopback interface only. There is no
+authentication, so do not expose it beyond localhost. Two checks keep web
+pages in the user's browser out:
+- POST bodies must be sent as application/json, which a page cannot do
+  cross-origin without the browser asking the daemon first.
+- The Host header must name the loopback address and port the daemon
+  listens on, which rules out DNS rebinding, where a page's own host name
+  is pointed at 127.0.0.1 to make its requests same-origin.
+
+    POST /info      {"url"}                           -> video info, from the shared metadata cache if warm
+    POST /jobs      {"url", "kind", "formats", "quality", "save_path", "priority", "weight"} -> {"id"}
+    GET  /jobs                                         -> every job's status
+    GET  /jobs/<id>                                    -> one job's status
+    POST /jobs/<id>/cancel {}                          -> stops a queued or running job; it ends as "cancelled"
+    GET  /events?since=N[&job=ID]                      -> newline-delimited JSON events, streamed as they happen
+    POST /limit     {"rate"}                           -> changes the bandwidth limit (bytes/s or e.g. "2M", null for none)
+
+"kind" is "video" or "audio"; "formats" is a list such as ["mp4", "mkv"]
+(or ["mp3", "wav"] for audio), all written from one download. Without a "quality" the best one (like the
+batch policy "best <format>") is picked.
+
+Events are "status" (a job changed state), "progress" (bytes transferred),
+"transcode" (ffmpeg's percentage and speed while it converts) and "limit".
+
+Usage:
+    python daemon.py --port 8765 -w 4 -t 2 --limit 4M --stream
+    python main.py --connect http://127.0.0.1:8765
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+from collections import deque
+from concurrent.futures import CancelledError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bandwidth import BandwidthScheduler, parse_rate
+from batch import AUDIO_FORMATS, VIDEO_FORMATS, Policy
+from cache import MetadataCache
+from downloader import DownloadCancelled, YouTubeDownloader
+from library import Library
+from metrics import MetricsRecorder
+from pipeline import Pipeline
+from utils import HTTP_TIMEOUT, ProgressAggregator, app_data_dir, http_session
+
+DEFAULT_PORT = 8765
+# Events kept for clients that reconnect with ?since=N
+EVENT_HISTORY = 10000
+# Finished jobs kept for GET /jobs; older ones are forgotten
+MAX_FINISHED_JOBS = 500
+# An idle event stream sends a blank line this often, so dead clients are noticed
+EVENT_KEEPALIVE = 15.0
+# Host names a request may address the daemon by; anything else is a web page's own name rebound to loopback
+LOOPBACK_HOSTS = ('127.0.0.1', 'localhost', '[::1]')
+
+
+class Job:
+    def __init__(self, job_id, request):
+        self.id = job_id
+        self.url = request['url']
+        self.kind = request.get('kind', 'video')
+        formats = request.get('formats') or ['mp3' if self.kind == 'audio' else 'mp4']
+        self.file_formats = [formats] if isinstance(formats, str) else formats
+        self.quality = request.get('quality')
+        self.save_path = request.get('save_path') or '.'
+        self.priority = int(request.get('priority', 0))
+        self.weight = float(request.get('weight', 1.0))
+        self.status = 'queued'
+        self.title = None
+        self.output_files = []
+        self.error = None
+        self.submitted_at = time.time()
+        self.downloader = None  # while the job runs
+        self.cancel_event = threading.Event()  # set by POST /jobs/<id>/cancel
+        self.recorder = None    # its timing spans, until they are saved
+
+    def to_dict(self):
+        return {'id': self.id, 'url': self.url, 'kind': self.kind, 'formats': self.file_formats,
+                'quality': self.quality, 'status': self.status, 'title': self.title,
+                'output_files': self.output_files, 'error': self.error, 'submitted_at': self.submitted_at}
+
+
+class DownloadService:
+    """
+    The shared engine behind the daemon: one pipeline, metadata cache,
+    library and bandwidth scheduler for every client. Job state changes and
+    coalesced progress are appended to an event log that clients follow.
+    Each job's timing spans are appended to `metrics_path` when it ends
+    (metrics.jsonl in the app's cache folder by default, like the GUI's).
+    With `streaming` set, jobs pipe their streams straight into ffmpeg.
+    """
+    def __init__(self, download_workers=4, transcode_workers=None, rate=None, metadata_cache=None, library=None,
+                 metrics_path=None, streaming=False):
+        self.pipeline = Pipeline(download_workers=download_workers, transcode_workers=transcode_workers)
+        self.metadata_cache = metadata_cache or MetadataCache()
+        self.library = library or Library()
+        self.scheduler = BandwidthScheduler(rate)
+        self.metrics_path = metrics_path or os.path.join(app_data_dir(), 'metrics.jsonl')
+        self.streaming = streaming
+        self.progress = ProgressAggregator(self._publish_progress)
+        self.jobs = {}
+        self._ids = itertools.count(1)
+        self._events = deque(maxlen=EVENT_HISTORY)
+        self._sequence = 0
+        self._cond = threading.Condition()
+
+    # --- Events ---
+    def _emit(self, event):
+        with self._cond:
+            self._sequence += 1
+            self._events.append(dict(event, seq=self._sequence))
+            self._cond.notify_all()
+
+    def _publish_progress(self, job_id):
+        snapshot = self.progress.snapshot(job_id)
+        if snapshot is not None:
+            self._emit({'type': 'progress', 'job': job_id, **snapshot})
+
+    def _set_status(self, job, status, **changes):
+        job.status = status
+        for name, value in changes.items():
+            setattr(job, name, value)
+        self._emit({'type': 'status', 'job': job.id, **job.to_dict()})
+
+    def events(self, since=0, job_id=None, timeout=None):
+        """
+        Events after sequence number `since` (of one job, if given), waiting up
+        to `timeout` seconds if there are none yet. Returns them with the
+        sequence number to pass as `since` next time.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._sequence > since, timeout)
+            events = [e for e in self._events if e['seq'] > since and (job_id is None or e['job'] == job_id)]
+            return events, self._sequence
+
+    # --- Jobs ---
+    def video_info(self, url, refresh=False):
+        downloader = YouTubeDownloader(metadata_cache=self.metadata_cache)
+        info = downloader.get_video_info(url, refresh=refresh)
+        return dict(info, video_id=downloader.video_id)
+
+    def submit(self, request):
+        if not request.get('url'):
+            raise ValueError("A job needs a 'url'.")
+        if request.get('kind', 'video') not in ('video', 'audio'):
+            raise ValueError("'kind' must be 'video' or 'audio'.")
+        try:
+            job = Job(str(next(self._ids)), request)
+        except TypeError:
+            raise ValueError("'priority' and 'weight' must be numbers.")
+        allowed = AUDIO_FORMATS if job.kind == 'audio' else VIDEO_FORMATS
+        if not isinstance(job.file_formats, list) or not all(f in allowed for f in job.file_formats):
+            raise ValueError(f"'formats' must be a list of {', '.join(allowed)} for {job.kind} jobs.")
+        # NaN or infinite weights would break the scheduler's fair-queuing order
+        if not 0 < job.weight < float('inf'):
+            raise ValueError("'weight' must be a positive number.")
+        with self._cond:
+            self.jobs[job.id] = job
+        self._emit({'type': 'status', 'job': job.id, **job.to_dict()})
+        future = self.pipeline.submit(lambda: self._fetch(job))
+        future.add_done_callback(lambda f: self._finished(job, f))
+        return job
+
+    def cancel(self, job_id):
+        """Stops a job: a queued one ends before it starts, a running one after its current chunk or ffmpeg poll."""
+        job = self.jobs[job_id]
+        job.cancel_event.set()
+        return job
+
+    def _fetch(self, job):
+        if job.cancel_event.is_set():
+            raise DownloadCancelled("Cancelled before it started.")
+        self._set_status(job, 'downloading')
+
+        def on_progress(stream, chunk, bytes_remaining):
+            self.progress.update(job.id, stream.filesize - bytes_remaining, stream.filesize)
+
+        def on_transcode(event):
+            self._emit({'type': 'transcode', 'job': job.id, **event})
+
+        job.recorder = MetricsRecorder()
+        downloader = YouTubeDownloader(on_progress, metadata_cache=self.metadata_cache, library=self.library,
+                                       job_metrics=job.recorder.job(job.id),
+                                       bandwidth=self.scheduler.share(job.weight, job.priority),
+                                       transcode_callback=on_transcode, cancel_event=job.cancel_event,
+                                       streaming=self.streaming)
+        job.downloader = downloader
+        video_info = downloader.get_video_info(job.url)
+        job.title = video_info['title']
+        quality = job.quality or Policy(job.kind, job.file_formats).select_quality(video_info)
+        os.makedirs(job.save_path, exist_ok=True)
+        if job.kind == 'audio':
+            task = downloader.fetch_audio(job.save_path, quality, audio_format=job.file_formats)
+        else:
+            task = downloader.fetch_video(job.save_path, quality, video_format=job.file_formats)
+        if task is not None:
+            self._set_status(job, 'converting', quality=quality)
+        return task
+
+    def _finished(self, job, future):
+        error = future.exception()
+        if isinstance(error, (DownloadCancelled, CancelledError)):
+            self._set_status(job, 'cancelled', error=str(error))
+        elif error is not None:
+            self._set_status(job, 'failed', error=str(error))
+        else:
+            # Includes files that needed no ffmpeg run: plain renames, library hits and streamed outputs
+            self._set_status(job, 'done', output_files=list(job.downloader.last_outputs))
+        self._release(job)
+
+    def _release(self, job):
+        """Drops what a finished job no longer needs, so a long-running daemon does not keep growing."""
+        self.progress.reset(job.id)
+        job.downloader = None  # holds the video's stream catalog and pytubefix objects
+        if job.recorder is not None:
+            try:
+                job.recorder.export_jsonl(self.metrics_path)
+            except OSError as e:
+                print(f"Could not save timing metrics: {e}")
+            job.recorder = None
+        with self._cond:
+            finished = [j for j in self.jobs.values() if j.status in ('done', 'failed', 'cancelled')]
+            for old in finished[:-MAX_FINISHED_JOBS]:
+                del self.jobs[old.id]
+
+    def set_rate(self, rate):
+        self.scheduler.set_rate(rate)
+        self._emit({'type': 'limit', 'job': None, 'rate': self.scheduler.rate})
+
+    def shutdown(self):
+        """Lets running jobs finish; queued ones are dropped."""
+        self.pipeline.shutdown(drop_pending=True)
+
+
+class _ApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        if not isinstance(body, dict):
+            raise ValueError("The request body must be a JSON object.")
+        return body
+
+    def _handle(self, method):
+        service = self.server.service
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        parts = [p for p in url.path.split('/') if p]
+        port = self.server.server_address[1]
+        if self.headers.get('Host', '').lower() not in {f"{host}:{port}" for host in LOOPBACK_HOSTS}:
+            self.close_connection = True
+            self._send_json(403, {'error': "Requests must address the daemon as 127.0.0.1, localhost or [::1]."})
+            return
+        content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if method == 'POST' and content_type != 'application/json':
+            # Form and text/plain bodies are what a page can POST cross-origin without a CORS preflight
+            self.close_connection = True  # the body is left unread
+            self._send_json(415, {'error': "POST bodies must be sent as application/json."})
+            return
+        try:
+            if method == 'POST' and parts == ['info']:
+                request = self._read_json()
+                self._send_json(200, service.video_info(request['url'], refresh=request.get('refresh', False)))
+            elif method == 'POST' and parts == ['jobs']:
+                self._send_json(201, service.submit(self._read_json()).to_dict())
+            elif method == 'GET' and parts == ['jobs']:
+                self._send_json(200, [job.to_dict() for job in list(service.jobs.values())])
+            elif method == 'GET' and len(parts) == 2 and parts[0] == 'jobs':
+                job = service.jobs.get(parts[1])
+                if job is None:
+                    self._send_json(404, {'error': f"No job {parts[1]}"})
+                else:
+                    self._send_json(200, job.to_dict())
+            elif method == 'POST' and len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'cancel':
+                self._read_json()  # empty, but read so the kept-alive connection stays in step
+                if parts[1] not in service.jobs:
+                    self._send_json(404, {'error': f"No job {parts[1]}"})
+                else:
+                    self._send_json(200, service.cancel(parts[1]).to_dict())
+            elif method == 'GET' and parts == ['events']:
+                self._stream_events(int(query.get('since', ['0'])[0]), query.get('job', [None])[0])
+            elif method == 'POST' and parts == ['limit']:
+                service.set_rate(self._read_json().get('rate'))
+                self._send_json(200, {'rate': service.scheduler.rate})
+            else:
+                self._send_json(404, {'error': f"Unknown endpoint {method} {url.path}"})
+        except (KeyError, ValueError) as e:
+            self._send_json(400, {'error': str(e)})
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+
+    def _stream_events(self, since, job_id):
+        """
+        Writes events as newline-delimited JSON until the client goes away.
+        Each batch is sent as one HTTP chunk, so clients see it immediately.
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        service = self.server.service
+        try:
+            while True:
+                events, latest = service.events(since, job_id, timeout=EVENT_KEEPALIVE)
+                data = b''.join(json.dumps(event).encode('utf-8') + b'\n' for event in events)
+                if latest == since:
+                    data = b'\n'  # keep-alive; fails once the client has gone
+                since = latest
+                if data:
+                    self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b'\r\n')
+        except ConnectionError:
+            pass
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DaemonServer:
+    """Serves a DownloadService on a loopback port from a background thread."""
+    def __init__(self, service, port=DEFAULT_PORT):
+        self.service = service
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), _ApiHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.service = service
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class DaemonClient:
+    """Talks to a running daemon over the shared HTTP session."""
+    def __init__(self, url=f"http://127.0.0.1:{DEFAULT_PORT}"):
+        self.url = url.rstrip('/')
+
+    def _call(self, method, path, body=None):
+        response = http_session().request(method, self.url + path, json=body, timeout=HTTP_TIMEOUT)
+        if response.status_code >= 400:
+            raise RuntimeError(response.json().get('error', f"Daemon returned HTTP {response.status_code}"))
+        return response.json()
+
+    def video_info(self, url, refresh=False):
+        return self._call('POST', '/info', {'url': url, 'refresh': refresh})
+
+    def submit(self, url, kind='video', file_formats=None, quality=None, save_path=None, priority=0, weight=1.0):
+        return self._call('POST', '/jobs', {'url': url, 'kind': kind, 'formats': file_formats, 'quality': quality,
+                                            'save_path': os.path.abspath(save_path or '.'),
+                                            'priority': priority, 'weight': weight})
+
+    def job(self, job_id):
+        return self._call('GET', f'/jobs/{job_id}')
+
+    def jobs(self):
+        return self._call('GET', '/jobs')
+
+    def cancel(self, job_id):
+        return self._call('POST', f'/jobs/{job_id}/cancel', {})
+
+    def set_rate(self, rate):
+        return self._call('POST', '/limit', {'rate': rate})
+
+    def events(self, since=0, job_id=None):
+        """Yields events as the daemon sends them; the stream stays open until the caller stops iterating."""
+        params = {'since': since}
+        if job_id is not None:
+            params['job'] = job_id
+        # The daemon sends a keep-alive line every EVENT_KEEPALIVE seconds, so a longer silence means it is gone
+        timeout = (HTTP_TIMEOUT[0], EVENT_KEEPALIVE * 3)
+        with http_session().get(self.url + '/events', params=params, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            # chunk_size=None hands over each HTTP chunk as it arrives instead of waiting to fill a buffer
+            for line in response.iter_lines(chunk_size=None):
+                if line:
+                    yield json.loads(line)
+
+
+class _RemoteProgress:
+    """Looks like a stream to a progress callback, like downloader._CombinedProgress."""
+    def __init__(self, filesize):
+        self.filesize = filesize
+
+
+class RemoteDownloader:
+    """
+    The part of the YouTubeDownloader interface the GUI uses, backed by a
+    daemon. Downloads are submitted as daemon jobs and block until the job
+    finishes, reporting the daemon's progress events to `progress_callback`
+    and its ffmpeg progress events to `transcode_callback`.
+    """
+    def __init__(self, progress_callback=None, url=f"http://127.0.0.1:{DEFAULT_PORT}", transcode_callback=None):
+        self.client = DaemonClient(url)
+        self.progress_callback = progress_callback
+        self.transcode_callback = transcode_callback
+        self.url = None
+        self.video_id = None
+        self.job_metrics = None  # timing is recorded by the daemon
+        self.cancel_event = threading.Event()
+        self._job_id = None  # the daemon job of the running download
+
+    def get_video_info(self, url, refresh=False):
+        info = self.client.video_info(url, refresh=refresh)
+        self.url, self.video_id = url, info['video_id']
+        return info
+
+    def cancel(self):
+        """Asks the daemon to stop the running job. A job left behind by a closed window keeps running there."""
+        self.cancel_event.set()
+        job_id = self._job_id
+        if job_id is not None:
+            self.client.cancel(job_id)
+
+    def begin_job(self):
+        self.cancel_event.clear()
+
+    def download_video(self, save_path, resolution, video_format='mp4'):
+        return self._run('video', save_path, resolution, video_format)
+
+    def download_audio(self, save_path, bitrate, audio_format='mp3'):
+        return self._run('audio', save_path, bitrate, audio_format)
+
+    def _run(self, kind, save_path, quality, file_formats):
+        job = self.client.submit(self.url, kind, file_formats, quality, save_path)
+        self._job_id = job['id']
+        try:
+            # cancel() may have run before the job had an id
+            if self.cancel_event.is_set():
+                self.client.cancel(job['id'])
+            return self._follow(job['id'])
+        finally:
+            self._job_id = None
+
+    def _follow(self, job_id):
+        for event in self.client.events(job_id=job_id):
+            if event['type'] == 'progress' and self.progress_callback:
+                self.progress_callback(_RemoteProgress(event['total']), b'', event['total'] - event['done'])
+            elif event['type'] == 'transcode' and self.transcode_callback:
+                self.transcode_callback({key: value for key, value in event.items() if key not in ('type', 'job', 'seq')})
+            elif event['type'] == 'status' and event['status'] == 'failed':
+                raise RuntimeError(event['error'])
+            elif event['type'] == 'status' and event['status'] == 'cancelled':
+                raise DownloadCancelled(event['error'])
+            elif event['type'] == 'status' and event['status'] == 'done':
+                return event['output_files']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run one shared download engine for local clients.")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f"Loopback port to listen on (default: {DEFAULT_PORT})")
+    parser.add_argument('-w', '--workers', type=int, default=4, help="Parallel downloads across all clients")
+    parser.add_argument('-t', '--transcode-workers', type=int, default=None, help="Parallel ffmpeg jobs (default: CPU cores)")
+    parser.add_argument('--limit', type=parse_rate, metavar='RATE', help="Cap the combined download rate, e.g. 500K or 2M (bytes/s)")
+    parser.add_argument('--metrics-jsonl', metavar='PATH', help="Append one JSON line per timed phase of every job to PATH "
+                                                                 "(default: metrics.jsonl in the app's cache folder)")
+    parser.add_argument('--stream', action='store_true', help="Pipe streams straight into ffmpeg instead of saving temp files first")
+    args = parser.parse_args(argv)
+
+    service = DownloadService(download_workers=max(1, args.workers), transcode_workers=args.transcode_workers, rate=args.limit,
+                              metrics_path=args.metrics_jsonl, streaming=args.stream)
+    with DaemonServer(service, args.port) as server:
+        print(f"Download daemon listening on {server.url} (Ctrl+C to stop)")
+        try:
+            server.thread.join()
+        except KeyboardInterrupt:
+            print("Stopping after the running jobs finish...")
+    service.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
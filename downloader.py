@@ -1,155 +1,1243 @@
-from pytubefix import YouTube
-import os
-import subprocess
-
-class YouTubeDownloader:
-    """
-    Handles the logic for downloading and converting video and audio from YouTube.
-    """
-    def __init__(self, progress_callback=None):
-        self.yt = None
-        self.progress_callback = progress_callback
-
-    def get_video_info(self, url):
-        self.yt = YouTube(url, on_progress_callback=self.progress_callback)
-
-        # --- Get Available Video Resolutions ---
-        video_streams = self.yt.streams.filter(file_extension='mp4').order_by('resolution').desc()
-        resolutions = sorted(list(set([s.resolution for s in video_streams if s.resolution])), key=lambda x: int(x.replace('p', '')), reverse=True)
-
-        # --- Get Available Audio Bitrates ---
-        audio_streams = self.yt.streams.filter(only_audio=True, file_extension='mp4').order_by('abr').desc()
-        bitrates = sorted(list(set([s.abr for s in audio_streams if s.abr])), key=lambda x: int(x.replace('kbps', '')), reverse=True)
-        
-        if not resolutions and not bitrates:
-            raise ConnectionError("No downloadable streams found for this video.")
-
-        return {
-            'title': self.yt.title,
-            'thumbnail_url': self.yt.thumbnail_url,
-            'video_resolutions': resolutions,
-            'audio_bitrates': bitrates
-        }
-
-    def _sanitize_filename(self, filename):
-        """Removes characters that are invalid for filenames."""
-        invalid_chars = '<>:"/\\|?*'
-        for char in invalid_chars:
-            filename = filename.replace(char, '')
-        return filename
-
-    def _get_unique_filename(self, file_path):
-        """
-        Checks if a file exists and returns a unique name by appending (1), (2), etc.
-        """
-        if not os.path.exists(file_path):
-            return file_path
-
-        directory, filename = os.path.split(file_path)
-        name, extension = os.path.splitext(filename)
-
-        counter = 1
-        while True:
-            new_filename = f"{name} ({counter}){extension}"
-            new_path = os.path.join(directory, new_filename)
-            if not os.path.exists(new_path):
-                return new_path
-            counter += 1
-
-    def download_video(self, save_path, resolution, video_format='mp4'):
-        print(f"Attempting to download video at {resolution}...")
-        
-        # Select the appropriate video stream
-        video_stream = self.yt.streams.filter(res=resolution, file_extension='mp4', progressive=True).first()
-        is_progressive = True
-        if not video_stream:
-            # If no progressive stream, find an adaptive (video-only) stream
-            video_stream = self.yt.streams.filter(res=resolution, file_extension='mp4', adaptive=True).first()
-            is_progressive = False
-
-        if not video_stream:
-            raise ValueError(f"No video stream found for resolution: {resolution}")
-        
-        sanitized_title = self._sanitize_filename(self.yt.title)
-        
-        if is_progressive:
-            print("Downloading progressive stream...")
-            temp_file = video_stream.download(output_path=save_path, filename=f"{sanitized_title}_temp.mp4")
-            
-            # Define the initial desired output file path
-            initial_output_file = os.path.join(save_path, f"{sanitized_title}.{video_format}")
-            final_output_file = self._get_unique_filename(initial_output_file)
-
-            if video_format != 'mp4':
-                self._run_ffmpeg_conversion(temp_file, final_output_file)
-            else:
-                os.rename(temp_file, final_output_file)
-        else:
-            print("Downloading adaptive streams (video and audio)...")
-            video_temp = video_stream.download(output_path=save_path, filename=f"{sanitized_title}_vid.mp4")
-            
-            audio_stream = self.yt.streams.filter(only_audio=True, file_extension='mp4').order_by('abr').desc().first()
-            audio_temp = audio_stream.download(output_path=save_path, filename=f"{sanitized_title}_aud.mp4")
-            
-            initial_output_file = os.path.join(save_path, f"{sanitized_title}.{video_format}")
-            final_output_file = self._get_unique_filename(initial_output_file)
-            
-            self._run_ffmpeg_merge(video_temp, audio_temp, final_output_file)
-
-    def download_audio(self, save_path, bitrate, audio_format='mp3'):
-        print(f"Attempting to download audio at {bitrate}...")
-        audio_stream = self.yt.streams.filter(abr=bitrate, only_audio=True, file_extension='mp4').first()
-
-        if not audio_stream:
-            raise ValueError(f"No audio stream found for bitrate: {bitrate}")
-
-        sanitized_title = self._sanitize_filename(self.yt.title)
-        temp_file = audio_stream.download(output_path=save_path, filename=f"{sanitized_title}_temp.mp4")
-        
-        initial_output_file = os.path.join(save_path, f"{sanitized_title}.{audio_format}")
-        final_output_file = self._get_unique_filename(initial_output_file)
-
-        self._run_ffmpeg_conversion(temp_file, final_output_file)
-
-    def _run_ffmpeg_conversion(self, input_file, output_file):
-        """Runs a simple ffmpeg conversion and cleans up the input file."""
-        command = ['ffmpeg', '-i', input_file, '-y', '-loglevel', 'error', output_file]
-        try:
-            print(f"Converting '{input_file}' to '{output_file}'...")
-            subprocess.run(command, check=True, creationflags=subprocess.CREATE_NO_WINDOW)
-            print("Conversion completed.")
-        except FileNotFoundError:
-            raise SystemError("ffmpeg not found. Please ensure it is installed and in your system's PATH.")
-        except subprocess.CalledProcessError as e:
-            raise RuntimeError(f"ffmpeg conversion failed: {e}")
-        finally:
-            if os.path.exists(input_file):
-                os.remove(input_file)
-
-    def _run_ffmpeg_merge(self, video_file, audio_file, output_file):
-        """Merges a video and audio file using ffmpeg and cleans up."""
-        command = [
-            'ffmpeg',
-            '-i', video_file,
-            '-i', audio_file,
-            '-c:v', 'copy', # Copy video stream without re-encoding
-            '-c:a', 'aac',  # Re-encode audio to AAC (standard for mp4)
-            '-strict', 'experimental',
-            '-y',
-            '-loglevel', 'error',
-            output_file
-        ]
-        try:
-            print(f"Merging video and audio to '{output_file}'...")
-            subprocess.run(command, check=True, creationflags=subprocess.CREATE_NO_WINDOW)
-            print("Merge completed.")
-        except FileNotFoundError:
-            raise SystemError("ffmpeg not found. Please ensure it is installed and in your system's PATH.")
-        except subprocess.CalledProcessError as e:
-            raise RuntimeError(f"ffmpeg merge failed: {e}")
-        finally:
-            if os.path.exists(video_file):
-                os.remove(video_file)
-            if os.path.exists(audio_file):
-                os.remove(audio_file)
-
+import json
+import os
+import re
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+
+import metrics
+from utils import HTTP_TIMEOUT, FilenameAllocator, http_session
+
+# pytubefix (and the network stack under it) is imported where a video is
+# first resolved, not here: it takes longer to import than the rest of the app.
+
+# Size of each read from the network, in bytes
+CHUNK_SIZE = 64 * 1024
+# Default number of byte ranges of a single stream fetched in parallel
+DEFAULT_SEGMENTS = 4
+# Largest byte range asked for in one request (pytubefix's request.default_range_size);
+# YouTube's media servers throttle or refuse much larger single requests
+RANGE_SIZE = 9 * 1024 * 1024
+# Streams smaller than this are not worth splitting
+MIN_SEGMENT_SIZE = 1024 * 1024
+# Times a byte range that timed out, dropped or hit a server error is retried from where it stopped
+RANGE_RETRIES = 3
+# How often, in seconds, a running download rewrites its resume manifest
+MANIFEST_SAVE_INTERVAL = 1.0
+# Bytes fetched up front to check whether an mp4 can be read by ffmpeg from a pipe
+PROBE_SIZE = 64 * 1024
+# Longest title kept in a file name, in characters; leaves room for " (n)", the extension and the folder path
+MAX_FILENAME_LENGTH = 150
+# The same limit in UTF-8 bytes: Linux and macOS allow 255 bytes per name, and a CJK character takes 3
+MAX_FILENAME_BYTES = 200
+# Cached stream URLs this close to their expiry are resolved again before a download
+URL_EXPIRY_MARGIN = 5 * 60
+# Only defined on Windows; keeps ffmpeg from flashing a console window there, and is 0 (no flags) elsewhere
+NO_WINDOW = getattr(subprocess, 'CREATE_NO_WINDOW', 0)
+# How often a running ffmpeg is checked for cancellation, in seconds
+FFMPEG_POLL_INTERVAL = 0.1
+# Lines of ffmpeg error output kept for the error message of a failed run
+FFMPEG_ERROR_LINES = 20
+
+
+class DownloadCancelled(Exception):
+    """Raised inside a transfer or an ffmpeg run when it is stopped before completion."""
+
+
+class _RangeNotSupported(Exception):
+    """Raised when the server ignores a Range header and sends the whole file."""
+
+
+class _RangeEndedEarly(ConnectionError):
+    """Raised when a byte range response closes before all of its bytes arrived."""
+
+
+def _retryable(error):
+    """
+    True for a transfer error worth another attempt: a timeout, a dropped
+    connection, a truncated range or a 5xx. Not for a 4xx (e.g. an expired
+    URL) or a local error such as a full disk or a closed pipe.
+    """
+    import requests  # already loaded by http_session()
+
+    if isinstance(error, _RangeEndedEarly):
+        return True
+    if not isinstance(error, requests.RequestException):
+        return False
+    return error.response is None or error.response.status_code >= 500
+
+
+class _CombinedProgress:
+    """
+    Folds several concurrent transfers into one byte-weighted progress figure.
+    It looks like a stream to the progress callback (it has a `filesize`), so
+    the callback sees a single transfer whose size is the sum of all parts.
+    """
+    def __init__(self, streams, callback):
+        self.filesize = sum(s.filesize for s in streams)
+        # Latest bytes_remaining of each part, so bytes resumed from disk count as done
+        self._remaining = {id(s): s.filesize for s in streams}
+        self._lock = threading.Lock()
+        self._callback = callback
+
+    def __call__(self, stream, chunk, bytes_remaining):
+        with self._lock:
+            self._remaining[id(stream)] = bytes_remaining
+            remaining = sum(self._remaining.values())
+        if self._callback:
+            self._callback(self, chunk, remaining)
+
+
+def _format_list(formats):
+    """Takes one format or a sequence of them; returns them lowercased, in order, without duplicates."""
+    if isinstance(formats, str):
+        formats = [formats]
+    formats = list(dict.fromkeys(f.lower() for f in formats))
+    if not formats:
+        raise ValueError("No output format requested.")
+    return formats
+
+
+def _quoted(paths):
+    return ", ".join(f"'{path}'" for path in paths)
+
+
+def _split_ranges(ranges, count):
+    """
+    Cuts [start, end) ranges into roughly `count` pieces of similar size for
+    parallel fetching, none larger than RANGE_SIZE.
+    """
+    total = sum(end - start for start, end in ranges)
+    if not total:
+        # Unknown size: a single open-ended request
+        return ranges
+    piece = min(max(-(-total // count), MIN_SEGMENT_SIZE // 4), RANGE_SIZE)
+    pieces = []
+    for start, end in ranges:
+        while start < end:
+            pieces.append((start, min(start + piece, end)))
+            start += piece
+    return pieces
+
+
+class _TempFiles:
+    """
+    Temp download names held by running jobs of this process. Temp names come
+    from the video ID and itag, so a retry resumes the same .part file; a
+    second job fetching the same stream at the same time gets a numbered
+    name instead of writing over the first one's.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_use = set()
+
+    def claim(self, path):
+        base, extension = os.path.splitext(path)
+        with self._lock:
+            candidate, counter = path, 1
+            while os.path.normcase(candidate) in self._in_use:
+                counter += 1
+                candidate = f"{base}.{counter}{extension}"
+            self._in_use.add(os.path.normcase(candidate))
+        return candidate
+
+    def release(self, *paths):
+        with self._lock:
+            for path in paths:
+                self._in_use.discard(os.path.normcase(path))
+
+
+_temp_files = _TempFiles()
+
+
+class _PartFile:
+    """
+    The `.part` file and JSON manifest of one stream download. The manifest
+    records the video ID, itag, total size and completed byte ranges; it is
+    only trusted when all of them match the stream being downloaded.
+    """
+    def __init__(self, output_file, video_id, stream):
+        self.output_file = output_file
+        self.path = output_file + '.part'
+        self.manifest_path = self.path + '.json'
+        self.total_size = stream.filesize
+        self.key = {'video_id': video_id, 'itag': stream.itag, 'filesize': self.total_size}
+        self.completed = []
+        self._lock = threading.Lock()
+        self._last_save = 0.0
+
+        if not self._load():
+            self.reset()
+        self.resumed_bytes = self.done_bytes()
+
+    def _load(self):
+        if not self.total_size:
+            return False  # nothing to resume against without a known size
+        try:
+            with open(self.manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+            if any(manifest.get(k) != v for k, v in self.key.items()):
+                return False
+            if os.path.getsize(self.path) != self.total_size:
+                return False
+        except (OSError, ValueError):
+            return False
+        self.completed = [tuple(r) for r in manifest.get('completed', [])]
+        return True
+
+    def reset(self):
+        """Starts over with an empty, preallocated .part file."""
+        with open(self.path, 'wb') as f:
+            f.truncate(self.total_size)
+        with self._lock:
+            self.completed = []
+        self.resumed_bytes = 0
+        self.save()
+
+    def done_bytes(self):
+        with self._lock:
+            return sum(end - start for start, end in self.completed)
+
+    def missing(self):
+        """The [start, end) ranges not downloaded yet."""
+        if not self.total_size:
+            return [(0, 0)]
+        gaps, position = [], 0
+        with self._lock:
+            for start, end in self.completed:
+                if start > position:
+                    gaps.append((position, start))
+                position = max(position, end)
+        if position < self.total_size:
+            gaps.append((position, self.total_size))
+        return gaps
+
+    def mark(self, start, end):
+        """Records [start, end) as written, merging it into the neighbouring ranges."""
+        with self._lock:
+            merged = []
+            for r_start, r_end in sorted(self.completed + [(start, end)]):
+                if merged and r_start <= merged[-1][1]:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], r_end))
+                else:
+                    merged.append((r_start, r_end))
+            self.completed = merged
+        if time.monotonic() - self._last_save >= MANIFEST_SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        with self._lock:
+            data = dict(self.key, completed=self.completed)
+            self._last_save = time.monotonic()
+            temp_path = f"{self.manifest_path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(temp_path, self.manifest_path)
+
+    def finish(self):
+        """Moves the completed download into place and drops the manifest."""
+        os.replace(self.path, self.output_file)
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+
+
+# Codecs each output container takes as-is; anything else is transcoded.
+# A video entry of None marks an audio-only container (the video is dropped).
+CONTAINER_CODECS = {
+    'mp4': {'video': {'h264', 'hevc', 'av1', 'vp9'}, 'audio': {'aac', 'mp3', 'opus'}},
+    'mov': {'video': {'h264', 'hevc'}, 'audio': {'aac', 'mp3'}},
+    'mkv': {'video': {'h264', 'hevc', 'av1', 'vp9', 'vp8'}, 'audio': {'aac', 'mp3', 'opus', 'vorbis'}},
+    'avi': {'video': set(), 'audio': {'mp3'}},
+    'm4a': {'video': None, 'audio': {'aac'}},
+    'aac': {'video': None, 'audio': {'aac'}},
+    'mp3': {'video': None, 'audio': {'mp3'}},
+    'wav': {'video': None, 'audio': set()},
+}
+
+# Manifest codec strings (avc1.640028, mp4a.40.2, vp09...) and ffmpeg's names, mapped to one vocabulary
+_CODEC_ALIASES = {'avc1': 'h264', 'h264': 'h264', 'hev1': 'hevc', 'hvc1': 'hevc', 'hevc': 'hevc',
+                  'av01': 'av1', 'av1': 'av1', 'vp09': 'vp9', 'vp9': 'vp9', 'vp8': 'vp8',
+                  'mp4a': 'aac', 'aac': 'aac', 'mp3': 'mp3', 'opus': 'opus', 'vorbis': 'vorbis'}
+
+
+def _normalize_codec(codec):
+    name = codec.split('.')[0].lower()
+    return _CODEC_ALIASES.get(name, name)
+
+
+# Removes characters Windows does not allow in file names, plus control characters
+_INVALID_FILENAME_CHARS = str.maketrans('', '', '<>:"/\\|?*' + ''.join(map(chr, range(32))))
+_RESERVED_FILENAMES = {'CON', 'PRN', 'AUX', 'NUL', *(f'COM{i}' for i in range(1, 10)), *(f'LPT{i}' for i in range(1, 10))}
+
+# Shared by every downloader in the process, so concurrent jobs never pick the same output name
+_filenames = FilenameAllocator()
+
+
+def _resolution_key(resolution):
+    return int(resolution.replace('p', ''))
+
+
+def _bitrate_key(bitrate):
+    return int(bitrate.replace('kbps', ''))
+
+
+class StreamDescriptor:
+    """
+    A stream rebuilt from the metadata cache. It has the attributes of a
+    pytubefix Stream that the catalog and the download engine use.
+    """
+    def __init__(self, data):
+        self.itag = data['itag']
+        self.url = data['url']
+        self.mime_type = data['mime_type']
+        self.resolution = data['resolution']
+        self.abr = data['abr']
+        self.is_progressive = data['is_progressive']
+        self.video_codec = data['video_codec']
+        self.audio_codec = data['audio_codec']
+        self.expires = data['expires']
+        self._filesize = data['filesize']
+
+    @property
+    def filesize(self):
+        # Like pytubefix, ask the server when the manifest had no content length
+        if not self._filesize:
+            response = http_session().head(self.url, allow_redirects=True, timeout=HTTP_TIMEOUT)
+            response.raise_for_status()
+            self._filesize = int(response.headers.get('Content-Length', 0))
+        return self._filesize
+
+    @staticmethod
+    def describe(stream):
+        """A JSON-friendly summary of a pytubefix Stream for the metadata cache."""
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(stream.url).query)
+        return {
+            'itag': stream.itag,
+            'url': stream.url,
+            'mime_type': stream.mime_type,
+            'resolution': stream.resolution,
+            'abr': stream.abr,
+            'is_progressive': stream.is_progressive,
+            'video_codec': stream.video_codec,
+            'audio_codec': stream.audio_codec,
+            # Read the manifest value directly; the filesize property would issue a request per stream
+            'filesize': getattr(stream, '_filesize', 0),
+            'expires': int(query['expire'][0]) if 'expire' in query else None,
+        }
+
+
+class StreamCatalog:
+    """
+    Indexes a video's mp4 streams in a single pass, so the info dialog and
+    the download methods answer with dictionary lookups instead of
+    re-filtering the stream list. Works on pytubefix Streams and on
+    StreamDescriptors alike.
+    """
+    def __init__(self, streams):
+        self.progressive = {}  # resolution -> progressive (video+audio) stream
+        self.adaptive = {}     # resolution -> adaptive (video-only) stream
+        self.audio = {}        # bitrate -> audio-only stream
+        self.expires = None    # earliest URL expiry (unix time) among cached streams
+
+        for stream in streams:
+            # Keep the first match, like StreamQuery.first() on the manifest order
+            if stream.mime_type == 'video/mp4' and stream.resolution:
+                table = self.progressive if stream.is_progressive else self.adaptive
+                table.setdefault(stream.resolution, stream)
+            elif stream.mime_type == 'audio/mp4' and stream.abr:
+                self.audio.setdefault(stream.abr, stream)
+            expires = getattr(stream, 'expires', None)
+            if expires is not None and (self.expires is None or expires < self.expires):
+                self.expires = expires
+
+        self.resolutions = sorted(set(self.progressive) | set(self.adaptive), key=_resolution_key, reverse=True)
+        self.bitrates = sorted(self.audio, key=_bitrate_key, reverse=True)
+        self.best_audio = self.audio[self.bitrates[0]] if self.bitrates else None
+
+    def video_stream(self, resolution):
+        """Returns (stream, is_progressive) for a resolution, or (None, False) if there is none."""
+        if resolution in self.progressive:
+            return self.progressive[resolution], True
+        return self.adaptive.get(resolution), False
+
+
+class TranscodeTask:
+    """
+    The CPU-bound half of a job: one ffmpeg conversion or merge of files that
+    have finished downloading, writing one output per requested format.
+    fetch_video/fetch_audio return one instead of running it, so the caller
+    decides where and when ffmpeg runs.
+    """
+    def __init__(self, downloader, kind, input_files, output_files, library_keys=None):
+        # `output_files` are the desired names; the unique names are picked when the task runs
+        self.downloader = downloader
+        self.kind = kind
+        self.input_files = input_files
+        self.output_files = output_files
+        # (itag, format) to index each finished file under, in the order of `output_files`
+        self.library_keys = library_keys or []
+
+    def discard(self):
+        """Drops a task that will not run, removing its temp inputs."""
+        self.downloader._remove_inputs(*self.input_files)
+
+    def run(self):
+        # Reserved only now, so a job that failed to download never leaves an empty placeholder
+        reserved = []
+        try:
+            for path in self.output_files:
+                reserved.append(self.downloader._get_unique_filename(path))
+        except BaseException:
+            self.downloader._remove_partial(*reserved)
+            self.downloader._remove_inputs(*self.input_files)
+            raise
+        self.output_files = reserved
+        with metrics.span(self.downloader.job_metrics, 'ffmpeg', child_cpu=True, kind=self.kind,
+                          outputs=len(self.output_files)) as span:
+            span.bytes = sum(os.path.getsize(path) for path in self.input_files if os.path.exists(path))
+            if self.kind == 'merge':
+                self.downloader._run_ffmpeg_merge(*self.input_files, self.output_files)
+            else:
+                self.downloader._run_ffmpeg_conversion(self.input_files[0], self.output_files)
+        self.downloader._record_outputs(self.library_keys, self.output_files)
+        return self.output_files
+
+
+def _progress_seconds(block):
+    # out_time_us is the current name; older ffmpeg builds only write out_time_ms, which is also in microseconds
+    value = block.get('out_time_us', block.get('out_time_ms'))
+    try:
+        return int(value) / 1_000_000
+    except (TypeError, ValueError):
+        return None  # "N/A" before the first frame is written
+
+
+class FFmpegProcess:
+    """
+    Runs one ffmpeg command as a managed child process. ffmpeg's `-progress`
+    report is parsed into events for `on_progress`: dicts with the media time
+    written so far ('out_time', in seconds), 'percentage' of `duration` (None
+    when the duration is unknown, e.g. for piped input), 'speed' as a multiple
+    of real time, output 'size' in bytes and 'done'. If `cancel_event` is set,
+    wait() kills ffmpeg and raises DownloadCancelled.
+    """
+    def __init__(self, command, duration=None, on_progress=None, cancel_event=None, stdin=None):
+        # Progress goes to stdout as key=value blocks; -nostats keeps the console status line out of stderr
+        self.command = [command[0], '-nostats', '-progress', 'pipe:1', *command[1:]]
+        self.duration = duration
+        self.on_progress = on_progress
+        self.cancel_event = cancel_event
+        self.last_progress = None
+        self._errors = deque(maxlen=FFMPEG_ERROR_LINES)
+        try:
+            self.process = subprocess.Popen(self.command, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                            creationflags=NO_WINDOW)
+        except FileNotFoundError:
+            raise SystemError("ffmpeg not found. Please ensure it is installed and in your system's PATH.")
+        self.stdin = self.process.stdin
+        self._readers = [threading.Thread(target=self._read_progress, daemon=True),
+                         threading.Thread(target=self._read_errors, daemon=True)]
+        for reader in self._readers:
+            reader.start()
+
+    def _read_progress(self):
+        block = {}
+        for line in self.process.stdout:
+            key, _, value = line.decode('utf-8', 'replace').strip().partition('=')
+            block[key] = value
+            # Every report ends with progress=continue, the last one with progress=end
+            if key == 'progress':
+                self._report(block, done=value == 'end')
+                block = {}
+
+    def _report(self, block, done):
+        out_time = _progress_seconds(block)
+        percentage = None
+        if self.duration:
+            percentage = 100.0 if done else min(out_time / self.duration * 100, 100.0) if out_time is not None else None
+        try:
+            speed = float(block.get('speed', '').rstrip('x'))
+        except ValueError:
+            speed = None
+        size = block.get('total_size', '')
+        self.last_progress = {'out_time': out_time, 'percentage': percentage, 'speed': speed,
+                              'size': int(size) if size.isdigit() else None, 'done': done}
+        if self.on_progress:
+            self.on_progress(self.last_progress)
+
+    def _read_errors(self):
+        for line in self.process.stderr:
+            self._errors.append(line.decode('utf-8', 'replace').rstrip())
+
+    @property
+    def errors(self):
+        """The last lines ffmpeg wrote to stderr."""
+        return "\n".join(line for line in self._errors if line)
+
+    def wait(self):
+        """Waits for ffmpeg to exit and returns its exit code. Kills it and raises DownloadCancelled if cancelled."""
+        while True:
+            try:
+                returncode = self.process.wait(timeout=FFMPEG_POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                if self.cancel_event is not None and self.cancel_event.is_set():
+                    self.kill()
+                    raise DownloadCancelled("ffmpeg was cancelled.")
+        for reader in self._readers:
+            reader.join()
+        return returncode
+
+    def kill(self):
+        """Stops ffmpeg at once, if it is still running."""
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        for reader in self._readers:
+            reader.join()
+
+    def failure(self, action):
+        """The error for a run that exited with a non-zero code."""
+        details = f": {self.errors}" if self.errors else ""
+        return RuntimeError(f"ffmpeg {action} failed with exit code {self.process.returncode}{details}")
+
+
+class YouTubeDownloader:
+    """
+    Handles the logic for downloading and converting video and audio from YouTube.
+    """
+    def __init__(self, progress_callback=None, segments=DEFAULT_SEGMENTS, streaming=False, metadata_cache=None, library=None,
+                 job_metrics=None, bandwidth=None, transcode_callback=None, cancel_event=None):
+        self.yt = None
+        self.url = None
+        self.title = None
+        self.video_id = None
+        self.catalog = None
+        self.progress_callback = progress_callback
+        self.segments = max(1, segments)
+        # When set, jobs that need ffmpeg pipe the download straight into it instead of a temp file
+        self.streaming = streaming
+        # Optional cache.MetadataCache; may be shared between several downloaders
+        self.metadata_cache = metadata_cache
+        # Optional library.Library of finished files, consulted before any transfer
+        self.library = library
+        # Optional metrics.JobMetrics that receives a timing span for every phase
+        self.job_metrics = job_metrics
+        # Optional bandwidth.Share; every chunk waits for its tokens before it is written or reported
+        self.bandwidth = bandwidth
+        # Receives FFmpegProcess progress events while ffmpeg converts or merges
+        self.transcode_callback = transcode_callback
+        # Set by cancel(); checked by every transfer and ffmpeg run of the current job.
+        # May be shared, e.g. a pipeline's, to stop several downloaders at once.
+        self.cancel_event = cancel_event or threading.Event()
+        # Every file the last fetch_video/fetch_audio produced or found in the library,
+        # including those its TranscodeTask writes once it has run
+        self.last_outputs = []
+
+    def cancel(self):
+        """
+        Stops the current job from another thread: transfers stop after their
+        current chunk and a running ffmpeg is killed. Partial outputs and temp
+        inputs are removed; .part files are kept, so the job can be resumed.
+        """
+        self.cancel_event.set()
+
+    def begin_job(self):
+        """
+        Clears an earlier cancel() before the downloader is reused. Call it
+        before the job's thread starts, so a cancel() that arrives while the
+        thread is starting is not lost.
+        """
+        self.cancel_event.clear()
+
+    def get_video_info(self, url, refresh=False):
+        """
+        Returns the title, thumbnail and available qualities of a video.
+        Answers from the metadata cache when it can; pass refresh=True to
+        resolve the video again, e.g. once its signed stream URLs have expired.
+        """
+        from pytubefix import extract
+
+        with metrics.span(self.job_metrics, 'metadata') as span:
+            self.url = url
+            self.video_id = extract.video_id(url)
+            span.attrs['video_id'] = self.video_id
+            if self.metadata_cache is not None and not refresh:
+                cached = self.metadata_cache.get(self.video_id)
+                if cached is not None:
+                    # Cached descriptors carry everything a download needs, so no pytubefix object is built
+                    span.attrs['cached'] = True
+                    self.yt = None
+                    self.title = cached['info']['title']
+                    self.catalog = StreamCatalog([StreamDescriptor(d) for d in cached['streams']])
+                    return cached['info']
+            span.attrs['cached'] = False
+            return self._resolve_video_info()
+
+    def _resolve_video_info(self):
+        """Builds the pytubefix object and the stream catalog for the current URL."""
+        from pytubefix import YouTube
+
+        url, video_id = self.url, self.video_id
+        self.yt = YouTube(url, on_progress_callback=self.progress_callback)
+        streams = list(self.yt.streams)
+        self.title = self.yt.title
+        self.catalog = StreamCatalog(streams)
+
+        if not self.catalog.resolutions and not self.catalog.bitrates:
+            raise ConnectionError("No downloadable streams found for this video.")
+
+        info = {
+            'title': self.title,
+            'thumbnail_url': self.yt.thumbnail_url,
+            'video_resolutions': self.catalog.resolutions,
+            'audio_bitrates': self.catalog.bitrates
+        }
+        if self.metadata_cache is not None:
+            descriptors = [StreamDescriptor.describe(s) for s in streams]
+            self.metadata_cache.put(video_id, {'info': info, 'streams': descriptors})
+        return info
+
+    def _fresh_catalog(self):
+        """Returns the current video's catalog, resolving the video again if its stream URLs are about to expire."""
+        if self.catalog is None:
+            raise ValueError("Call get_video_info before downloading.")
+        expires = self.catalog.expires
+        if expires is not None and expires - time.time() < URL_EXPIRY_MARGIN:
+            print("Cached stream URLs have expired, resolving the video again...")
+            self.get_video_info(self.url, refresh=True)
+        return self.catalog
+
+    def _sanitize_filename(self, filename):
+        """
+        Makes a title safe to use as a file name on every platform, in a single
+        pass: drops invalid and control characters, trailing dots and spaces,
+        avoids reserved Windows device names and caps the length.
+        """
+        filename = filename.translate(_INVALID_FILENAME_CHARS).strip().rstrip('. ')
+        filename = filename[:MAX_FILENAME_LENGTH]
+        # Cut at a character boundary, dropping a multi-byte character split by the byte limit
+        filename = filename.encode('utf-8')[:MAX_FILENAME_BYTES].decode('utf-8', 'ignore').rstrip('. ')
+        if not filename:
+            return "video"
+        if filename.split('.')[0].upper() in _RESERVED_FILENAMES:
+            filename = f"_{filename}"
+        return filename
+
+    def _get_unique_filename(self, file_path):
+        """
+        Reserves and returns a unique name for `file_path`, appending (1), (2), etc.
+        when it is taken. The file exists (empty) on return; the caller overwrites it.
+        """
+        return _filenames.reserve(file_path)
+
+    def download_video(self, save_path, resolution, video_format='mp4'):
+        """Downloads and converts in one go. Returns the paths of the finished files."""
+        task = self.fetch_video(save_path, resolution, video_format)
+        if task is not None:
+            task.run()
+        return self.last_outputs
+
+    def download_audio(self, save_path, bitrate, audio_format='mp3'):
+        """Downloads and converts in one go. Returns the paths of the finished files."""
+        task = self.fetch_audio(save_path, bitrate, audio_format)
+        if task is not None:
+            task.run()
+        return self.last_outputs
+
+    def fetch_video(self, save_path, resolution, video_format='mp4'):
+        """
+        The network half of download_video. `video_format` may also be a list of
+        formats, e.g. ['mp4', 'mkv']: the stream is downloaded once and a single
+        ffmpeg run writes every format. Returns the TranscodeTask still to be
+        run, or None if every format is already in its final place.
+        """
+        formats = _format_list(video_format)
+        self.last_outputs = []
+        print(f"Attempting to download video at {resolution}...")
+        catalog = self._fresh_catalog()
+
+        # Prefer a progressive stream; otherwise fall back to an adaptive (video-only) one
+        video_stream, is_progressive = catalog.video_stream(resolution)
+        if not video_stream:
+            raise ValueError(f"No video stream found for resolution: {resolution}")
+        audio_stream = None if is_progressive else catalog.best_audio
+        if not is_progressive and not audio_stream:
+            raise ValueError("No audio stream found to merge with the video.")
+
+        sanitized_title = self._sanitize_filename(self.title)
+        itag = video_stream.itag if is_progressive else f"{video_stream.itag}+{audio_stream.itag}"
+        library_keys, output_files = self._pending_outputs(save_path, sanitized_title, itag, formats)
+        if not output_files:
+            return None
+        pending_formats = [file_format for _, file_format in library_keys]
+
+        # The output names are only reserved once there is something to write to them
+        if is_progressive:
+            if pending_formats != ['mp4'] and self._can_stream(video_stream):
+                print("Streaming progressive stream into ffmpeg...")
+                final_output_files = [self._get_unique_filename(path) for path in output_files]
+                self._stream_ffmpeg_conversion(video_stream, final_output_files)
+                self._record_outputs(library_keys, final_output_files)
+                return None
+
+            print("Downloading progressive stream...")
+            temp_file, = self._fetch_temp(save_path, video_stream)
+
+            if pending_formats != ['mp4']:
+                return TranscodeTask(self, 'convert', [temp_file], output_files, library_keys)
+            try:
+                final_output_file = self._get_unique_filename(output_files[0])
+            except BaseException:
+                self._remove_inputs(temp_file)
+                raise
+            os.replace(temp_file, final_output_file)
+            _temp_files.release(temp_file)
+            self._record_outputs(library_keys, [final_output_file])
+            return None
+        else:
+            # Two live inputs need named pipes, which only exist on POSIX systems
+            if hasattr(os, 'mkfifo') and self._can_stream(video_stream, audio_stream):
+                print("Streaming adaptive streams (video and audio) into ffmpeg...")
+                final_output_files = [self._get_unique_filename(path) for path in output_files]
+                self._stream_ffmpeg_merge(video_stream, audio_stream, final_output_files)
+                self._record_outputs(library_keys, final_output_files)
+                return None
+
+            print("Downloading adaptive streams (video and audio)...")
+            video_temp, audio_temp = self._fetch_temp(save_path, video_stream, audio_stream)
+            return TranscodeTask(self, 'merge', [video_temp, audio_temp], output_files, library_keys)
+
+    def fetch_audio(self, save_path, bitrate, audio_format='mp3'):
+        """
+        The network half of download_audio. Like fetch_video, `audio_format` may
+        be a list of formats written from one download. Returns the TranscodeTask
+        still to be run, or None.
+        """
+        formats = _format_list(audio_format)
+        self.last_outputs = []
+        print(f"Attempting to download audio at {bitrate}...")
+        audio_stream = self._fresh_catalog().audio.get(bitrate)
+
+        if not audio_stream:
+            raise ValueError(f"No audio stream found for bitrate: {bitrate}")
+
+        sanitized_title = self._sanitize_filename(self.title)
+        library_keys, output_files = self._pending_outputs(save_path, sanitized_title, audio_stream.itag, formats)
+        if not output_files:
+            return None
+
+        if self._can_stream(audio_stream):
+            final_output_files = [self._get_unique_filename(path) for path in output_files]
+            self._stream_ffmpeg_conversion(audio_stream, final_output_files)
+            self._record_outputs(library_keys, final_output_files)
+            return None
+
+        temp_file, = self._fetch_temp(save_path, audio_stream)
+        return TranscodeTask(self, 'convert', [temp_file], output_files, library_keys)
+
+    def _pending_outputs(self, save_path, sanitized_title, itag, formats):
+        """
+        Desired output paths for every format the library cannot already supply.
+        Returns ([(itag, format), ...], [path, ...]) in matching order.
+        """
+        library_keys, output_files = [], []
+        for file_format in formats:
+            output_file = os.path.join(save_path, f"{sanitized_title}.{file_format}")
+            existing = self._from_library(itag, file_format, output_file)
+            if existing is not None:
+                self.last_outputs.append(existing)
+            else:
+                library_keys.append((itag, file_format))
+                output_files.append(output_file)
+        return library_keys, output_files
+
+    def _from_library(self, itag, file_format, output_file):
+        """
+        Satisfies a job from the library index when this video was already saved
+        at the same itag and format: nothing to do if the file is already in the
+        target folder, otherwise a hardlink/copy of it instead of a transfer.
+        Returns the path of the file in the target folder, or None.
+        """
+        if self.library is None or self.video_id is None:
+            return None
+        existing = self.library.lookup(self.video_id, itag, file_format)
+        if existing is None:
+            return None
+        if os.path.dirname(existing) == os.path.dirname(os.path.abspath(output_file)):
+            print(f"Already downloaded as '{existing}', nothing to do.")
+            return existing
+        print(f"Re-using '{existing}' instead of downloading it again...")
+        target = self._get_unique_filename(output_file)
+        self.library.materialize(existing, target)
+        return target
+
+    def _add_to_library(self, itag, file_format, path):
+        if self.library is not None and self.video_id is not None:
+            self.library.record(self.video_id, itag, file_format, path)
+
+    def _record_outputs(self, library_keys, output_files):
+        self.last_outputs.extend(output_files)
+        for (itag, file_format), path in zip(library_keys, output_files):
+            self._add_to_library(itag, file_format, path)
+
+    def _fetch_temp(self, save_path, *streams):
+        """
+        Downloads streams to temp files in `save_path` and returns their paths.
+        The names come from the video ID and itag rather than the title, so
+        videos that share a title never share a temp or .part file, while a
+        retry of the same job still resumes its own.
+        """
+        owner = self.video_id or self._sanitize_filename(self.title)
+        temp_files = [_temp_files.claim(os.path.join(save_path, f".{owner}.{stream.itag}.mp4")) for stream in streams]
+        try:
+            if len(streams) == 1:
+                self._download_stream(streams[0], temp_files[0], self.progress_callback)
+            else:
+                # All halves are fetched at the same time; total time is the slowest transfer, not the sum
+                self._download_concurrently(list(zip(streams, temp_files)))
+        except BaseException:
+            # A half that did finish is useless without the other; .part files of the rest stay for a retry
+            self._remove_inputs(*temp_files)
+            raise
+        return temp_files
+
+    def _download_stream(self, stream, output_file, on_progress=None, cancel_event=None):
+        """
+        Downloads a single stream to `output_file`, reporting each chunk to `on_progress`
+        with the usual (stream, chunk, bytes_remaining) signature.
+
+        Bytes go to `output_file.part` and a small manifest records the completed
+        byte ranges, so if the job is interrupted, the next attempt for the same
+        video and itag only fetches what is missing. Large streams are split into
+        parallel byte ranges; a server that ignores Range headers gets one plain
+        connection instead. Stops with DownloadCancelled as soon as `cancel_event` is set.
+        """
+        with metrics.span(self.job_metrics, 'transfer', itag=stream.itag) as span:
+            part = _PartFile(output_file, self.video_id, stream)
+            if part.resumed_bytes:
+                print(f"Resuming '{output_file}' from {part.resumed_bytes} of {part.total_size} bytes...")
+                span.attrs['resumed_bytes'] = part.resumed_bytes
+                if on_progress:
+                    on_progress(stream, b'', part.total_size - part.resumed_bytes)
+            try:
+                try:
+                    self._download_ranges(stream, part, on_progress, cancel_event)
+                except _RangeNotSupported:
+                    print("Server does not support byte ranges, downloading over a single connection.")
+                    part.reset()
+                    self._download_ranges(stream, part, on_progress, cancel_event, workers=1, split=False)
+            finally:
+                part.save()
+                span.bytes = part.done_bytes() - part.resumed_bytes
+            part.finish()
+        return output_file
+
+    def _download_ranges(self, stream, part, on_progress=None, cancel_event=None, workers=None, split=True):
+        """
+        Fetches every byte range `part` is still missing over a pool of `workers`
+        (the downloader's segment count by default), in pieces of at most
+        RANGE_SIZE, writing each straight to its offset in the preallocated
+        .part file. With split=False every missing range is one request.
+        """
+        workers = workers or (self.segments if part.total_size >= MIN_SEGMENT_SIZE else 1)
+        ranges = _split_ranges(part.missing(), workers) if split else part.missing()
+        if not ranges:
+            return
+
+        # Stops the sibling ranges of this stream only; `cancel_event` may be shared with other streams
+        stop_event = threading.Event()
+        # Shared by all workers so the callback sees one monotonically growing total
+        lock = threading.Lock()
+        state = {'downloaded': part.resumed_bytes}
+
+        def report(chunk):
+            with lock:
+                state['downloaded'] += len(chunk)
+                remaining = part.total_size - state['downloaded']
+            if on_progress:
+                on_progress(stream, chunk, max(remaining, 0))
+
+        def cancelled():
+            return (stop_event.is_set() or self.cancel_event.is_set()
+                    or (cancel_event is not None and cancel_event.is_set()))
+
+        def fetch_range(start, end):
+            # Pieces still queued when a sibling failed or the job was cancelled are not started
+            if cancelled():
+                raise DownloadCancelled(f"Download of '{part.output_file}' was cancelled.")
+            position, attempt = start, 0
+            while True:
+                headers = {'Range': f'bytes={position}-{end - 1}'} if part.total_size else {}
+                try:
+                    with http_session().get(stream.url, headers=headers, stream=True, timeout=HTTP_TIMEOUT) as response, \
+                            open(part.path, 'r+b') as f:
+                        response.raise_for_status()
+                        # A 200 is only acceptable when we asked for the whole file anyway
+                        if response.status_code != 206 and (position, end) != (0, part.total_size):
+                            raise _RangeNotSupported()
+                        f.seek(position)
+                        for chunk in response.iter_content(CHUNK_SIZE):
+                            if part.total_size:
+                                chunk = chunk[:end - position]
+                            if cancelled() or (self.bandwidth is not None and not self.bandwidth.acquire(len(chunk), cancelled)):
+                                raise DownloadCancelled(f"Download of '{part.output_file}' was cancelled.")
+                            f.write(chunk)
+                            part.mark(position, position + len(chunk))
+                            position += len(chunk)
+                            report(chunk)
+                            if part.total_size and position >= end:
+                                break
+                    if part.total_size and position != end:
+                        raise _RangeEndedEarly(f"Byte range {start}-{end - 1} of '{part.output_file}' ended early.")
+                    return
+                except Exception as e:
+                    attempt += 1
+                    # Without a known size there is no offset to carry on from
+                    if attempt > RANGE_RETRIES or not part.total_size or not _retryable(e):
+                        raise
+                    print(f"Byte range {position}-{end - 1} of '{part.output_file}' failed ({e}), retrying...")
+                    stop_event.wait(attempt)
+                    if cancelled():
+                        raise DownloadCancelled(f"Download of '{part.output_file}' was cancelled.")
+
+        with ThreadPoolExecutor(max_workers=min(workers, len(ranges))) as pool:
+            futures = [pool.submit(metrics.profile_worker(fetch_range), start, end) for start, end in ranges]
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            failed = [f for f in done if f.exception() is not None]
+            if failed:
+                stop_event.set()
+                wait(futures)
+                raise failed[0].exception()
+
+    def _pump(self, stream, sink, on_progress=None, cancel_event=None):
+        """
+        Copies a whole stream, in order, into any writable binary file object,
+        one RANGE_SIZE request after another. A server that ignores Range
+        headers sends everything in reply to the first one.
+        """
+        total_size = stream.filesize
+        downloaded = 0
+
+        def cancelled():
+            return self.cancel_event.is_set() or (cancel_event is not None and cancel_event.is_set())
+
+        attempt = 0
+        while True:
+            start, end = downloaded, min(downloaded + RANGE_SIZE, total_size)
+            # Without a known size there is nothing to window: one plain request fetches it all
+            headers = {'Range': f'bytes={start}-{end - 1}'} if total_size else {}
+            try:
+                with http_session().get(stream.url, headers=headers, stream=True, timeout=HTTP_TIMEOUT) as response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        if downloaded:
+                            raise ConnectionError(f"Server stopped honouring byte ranges for '{stream.url}'.")
+                        end = None  # the whole stream comes in this response
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        if cancelled() or (self.bandwidth is not None and not self.bandwidth.acquire(len(chunk), cancelled)):
+                            raise DownloadCancelled("Download was cancelled.")
+                        sink.write(chunk)
+                        downloaded += len(chunk)
+                        if on_progress:
+                            on_progress(stream, chunk, max(total_size - downloaded, 0))
+                if total_size and end is not None and downloaded < end:
+                    raise _RangeEndedEarly(f"Byte range {start}-{end - 1} of '{stream.url}' ended early.")
+            except Exception as e:
+                attempt += 1
+                # Only a windowed transfer can carry on from where it stopped; the sink already has the rest
+                if attempt > RANGE_RETRIES or not total_size or end is None or not _retryable(e):
+                    raise
+                print(f"Transfer stopped at byte {downloaded} of {total_size} ({e}), retrying...")
+                self.cancel_event.wait(attempt)
+                continue
+            if not total_size or end is None or downloaded >= total_size:
+                return
+            attempt = 0
+
+    def _download_concurrently(self, jobs):
+        """
+        Downloads several (stream, output_file) pairs at the same time.
+        Progress is combined into one byte-weighted figure for the progress callback.
+        If any transfer fails, the others are cancelled and the first error is raised;
+        the .part files are kept so a retry can resume every half.
+        """
+        cancel_event = threading.Event()
+        progress = _CombinedProgress([stream for stream, _ in jobs], self.progress_callback)
+
+        with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            futures = [pool.submit(metrics.profile_worker(self._download_stream), stream, path, progress, cancel_event)
+                       for stream, path in jobs]
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            failed = [f for f in done if f.exception() is not None]
+            if failed:
+                cancel_event.set()
+                wait(futures)
+                raise failed[0].exception()
+        return [f.result() for f in futures]
+
+    def _can_stream(self, *streams):
+        """
+        True if streaming mode is on and every stream can be read by ffmpeg from a pipe.
+        An mp4 whose index (moov) sits after the media data needs a seekable input,
+        so those keep going through a temp file.
+        """
+        if not self.streaming:
+            return False
+        for stream in streams:
+            try:
+                with http_session().get(stream.url, headers={'Range': f'bytes=0-{PROBE_SIZE - 1}'}, stream=True,
+                                        timeout=HTTP_TIMEOUT) as response:
+                    response.raise_for_status()
+                    head = response.raw.read(PROBE_SIZE)
+            except OSError as e:
+                print(f"Could not probe stream, using a temp file instead: {e}")
+                return False
+            if not self._is_streamable_mp4(head):
+                return False
+        return True
+
+    @staticmethod
+    def _is_streamable_mp4(head):
+        """Walks the top-level mp4 boxes in `head` and reports whether the index comes before the media data."""
+        offset = 0
+        while offset + 8 <= len(head):
+            size, box_type = struct.unpack('>I4s', head[offset:offset + 8])
+            if box_type in (b'moov', b'moof'):
+                return True
+            if box_type == b'mdat':
+                return False
+            if size == 1 and offset + 16 <= len(head):
+                size = struct.unpack('>Q', head[offset + 8:offset + 16])[0]
+            if size < 8:
+                return False
+            offset += size
+        return False
+
+    def _probe_media(self, *input_files):
+        """
+        Reads the codec of the first video and audio stream across `input_files`,
+        and the longest duration, from ffmpeg's own banner, so no separate ffprobe
+        binary has to be shipped. Returns e.g. ({'video': 'h264', 'audio': 'aac'}, 212.5);
+        missing codec keys and a None duration mean unknown.
+        """
+        codecs, duration = {}, None
+        for input_file in input_files:
+            try:
+                result = subprocess.run(['ffmpeg', '-hide_banner', '-i', input_file], capture_output=True,
+                                        text=True, errors='replace', creationflags=NO_WINDOW)
+            except FileNotFoundError:
+                raise SystemError("ffmpeg not found. Please ensure it is installed and in your system's PATH.")
+            for kind, codec in re.findall(r'Stream #\d+:\d+.*?: (Video|Audio): (\w+)', result.stderr):
+                codecs.setdefault(kind.lower(), _normalize_codec(codec))
+            match = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', result.stderr)
+            if match:
+                hours, minutes, seconds = match.groups()
+                duration = max(duration or 0, int(hours) * 3600 + int(minutes) * 60 + float(seconds))
+        return codecs, duration
+
+    @staticmethod
+    def _stream_codecs(*streams):
+        """Codecs as announced in the stream manifest, for inputs that cannot be probed (pipes)."""
+        codecs = {}
+        for stream in streams:
+            if getattr(stream, 'video_codec', None):
+                codecs.setdefault('video', _normalize_codec(stream.video_codec))
+            if getattr(stream, 'audio_codec', None):
+                codecs.setdefault('audio', _normalize_codec(stream.audio_codec))
+        return codecs
+
+    def _codec_args(self, codecs, output_file):
+        """
+        Chooses per-stream ffmpeg codec options for the output container: stream
+        copy (a remux) wherever the container accepts the source codec, and a
+        transcode only where it does not, e.g. for MP3, WAV or AVI.
+        """
+        container = os.path.splitext(output_file)[1].lstrip('.').lower()
+        allowed = CONTAINER_CODECS.get(container)
+        if allowed is None:
+            return []  # unknown container: let ffmpeg pick
+
+        args, copied = [], []
+        if allowed['video'] is None:
+            args.append('-vn')  # audio-only container
+        elif codecs.get('video') in allowed['video']:
+            args += ['-c:v', 'copy']
+            copied.append('video')
+        if codecs.get('audio') in allowed['audio']:
+            args += ['-c:a', 'copy']
+            copied.append('audio')
+        elif codecs.get('audio') and 'aac' in allowed['audio']:
+            args += ['-c:a', 'aac', '-strict', 'experimental']
+
+        transcoded = [kind for kind in ('video', 'audio') if codecs.get(kind) and kind not in copied
+                      and not (kind == 'video' and allowed['video'] is None)]
+        print(f"ffmpeg plan for .{container}: copy {', '.join(copied) or 'nothing'}, "
+              f"transcode {', '.join(transcoded) or 'nothing'}")
+        return args
+
+    def _output_args(self, codecs, output_files, fallback=()):
+        """
+        The codec options and name of every output of one ffmpeg run. ffmpeg reads
+        and decodes the input once and feeds all outputs from it, so each extra
+        format costs only its own encode, or nothing where it is a stream copy.
+        """
+        args = []
+        for output_file in output_files:
+            codec_args = self._codec_args(codecs, output_file) if codecs else list(fallback)
+            args += [*codec_args, output_file]
+        return args
+
+    def _conversion_command(self, input_file, output_files, codecs):
+        return ['ffmpeg', '-y', '-loglevel', 'error', '-i', input_file, *self._output_args(codecs, output_files)]
+
+    def _merge_command(self, video_file, audio_file, output_files, codecs):
+        # If the codecs could not be told apart, copy the video and make the audio AAC, which always fits mp4
+        fallback = ['-c:v', 'copy', '-c:a', 'aac', '-strict', 'experimental']
+        return [
+            'ffmpeg',
+            '-y',
+            '-loglevel', 'error',
+            '-i', video_file,
+            '-i', audio_file,
+            *self._output_args(codecs, output_files, fallback)
+        ]
+
+    def _ffmpeg(self, command, duration=None, stdin=None):
+        """Starts a managed ffmpeg run that reports to the transcode callback and stops when the job is cancelled."""
+        return FFmpegProcess(command, duration, self.transcode_callback, self.cancel_event, stdin)
+
+    def _stream_ffmpeg_conversion(self, stream, output_files):
+        """Converts a stream to every output while it downloads by piping it into ffmpeg's stdin. No temp file is written."""
+        print(f"Converting stream to {_quoted(output_files)} as it downloads...")
+        with metrics.span(self.job_metrics, 'stream_ffmpeg', child_cpu=True, kind='convert', itag=stream.itag) as span:
+            span.bytes = stream.filesize
+            process = None
+            try:
+                process = self._ffmpeg(self._conversion_command('pipe:0', output_files, self._stream_codecs(stream)),
+                                       stdin=subprocess.PIPE)
+                try:
+                    self._pump(stream, process.stdin, self.progress_callback)
+                finally:
+                    process.stdin.close()
+                if process.wait() != 0:
+                    raise process.failure("conversion")
+                print("Conversion completed.")
+            except BrokenPipeError:
+                process.wait()
+                self._remove_partial(*output_files)
+                raise process.failure("conversion")
+            except BaseException:
+                if process is not None:
+                    process.kill()
+                self._remove_partial(*output_files)
+                raise
+
+    def _stream_ffmpeg_merge(self, video_stream, audio_stream, output_files):
+        """
+        Merges video and audio into every output while both download, feeding ffmpeg through two named pipes.
+        Each pipe has its own writer thread, so ffmpeg can read the inputs in whatever
+        order it likes. No temp media files are written.
+        """
+        fifo_dir = tempfile.mkdtemp(prefix='gaan_ta_namao_')
+        video_fifo = os.path.join(fifo_dir, 'video')
+        audio_fifo = os.path.join(fifo_dir, 'audio')
+        os.mkfifo(video_fifo)
+        os.mkfifo(audio_fifo)
+
+        cancel_event = threading.Event()
+        progress = _CombinedProgress([video_stream, audio_stream], self.progress_callback)
+
+        def feed(stream, fifo):
+            try:
+                with open(fifo, 'wb') as sink:
+                    self._pump(stream, sink, progress, cancel_event)
+            except BaseException:
+                # Stop the other half too, so ffmpeg sees both inputs end
+                cancel_event.set()
+                raise
+
+        command = self._merge_command(video_fifo, audio_fifo, output_files, self._stream_codecs(video_stream, audio_stream))
+        with metrics.span(self.job_metrics, 'stream_ffmpeg', child_cpu=True, kind='merge',
+                          itag=f"{video_stream.itag}+{audio_stream.itag}") as span:
+            span.bytes = video_stream.filesize + audio_stream.filesize
+            try:
+                process = self._ffmpeg(command)
+                print(f"Merging video and audio to {_quoted(output_files)} as they download...")
+                with ThreadPoolExecutor(max_workers=2) as pool:
+                    feeder = metrics.profile_worker(feed)
+                    futures = [pool.submit(feeder, video_stream, video_fifo), pool.submit(feeder, audio_stream, audio_fifo)]
+                    try:
+                        returncode = process.wait()
+                    finally:
+                        # If ffmpeg gave up early or was killed, a writer may still be blocked opening its pipe;
+                        # open the read ends ourselves so every writer wakes up and fails instead of hanging.
+                        cancel_event.set()
+                        for fifo in (video_fifo, audio_fifo):
+                            os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+                        wait(futures)
+
+                # A failed transfer is the root cause even if ffmpeg then choked on the truncated input
+                errors = [f.exception() for f in futures if f.exception() is not None]
+                transfer_errors = [e for e in errors if not isinstance(e, (BrokenPipeError, DownloadCancelled))]
+                if transfer_errors:
+                    raise transfer_errors[0]
+                if returncode != 0:
+                    raise process.failure("merge")
+                if errors:
+                    raise errors[0]
+                print("Merge completed.")
+            except BaseException:
+                self._remove_partial(*output_files)
+                raise
+            finally:
+                shutil.rmtree(fifo_dir, ignore_errors=True)
+
+    def _remove_partial(self, *paths):
+        """Deletes a failed job's outputs and frees their reserved names."""
+        for path in paths:
+            _filenames.release(path)
+
+    def _run_ffmpeg(self, action, build_command, input_files, output_files):
+        """
+        Probes the finished temp files and runs the conversion or merge that
+        `build_command(codecs)` returns. The inputs are always removed afterwards;
+        the outputs too if anything failed, ffmpeg was missing or the job was cancelled.
+        """
+        try:
+            codecs, duration = self._probe_media(*input_files)
+            process = self._ffmpeg(build_command(codecs), duration)
+            if process.wait() != 0:
+                raise process.failure(action)
+        except BaseException:
+            self._remove_partial(*output_files)
+            raise
+        finally:
+            self._remove_inputs(*input_files)
+
+    def _remove_inputs(self, *input_files):
+        """Deletes a job's finished temp files and frees their names."""
+        for input_file in input_files:
+            if os.path.exists(input_file):
+                os.remove(input_file)
+        _temp_files.release(*input_files)
+
+    def _run_ffmpeg_conversion(self, input_file, output_files):
+        """Converts a file to every output in one ffmpeg run and cleans up the input file."""
+        print(f"Converting '{input_file}' to {_quoted(output_files)}...")
+        self._run_ffmpeg("conversion", lambda codecs: self._conversion_command(input_file, output_files, codecs),
+                         [input_file], output_files)
+        print("Conversion completed.")
+
+    def _run_ffmpeg_merge(self, video_file, audio_file, output_files):
+        """Merges a video and audio file into every output in one ffmpeg run and cleans up."""
+        print(f"Merging video and audio to {_quoted(output_files)}...")
+        self._run_ffmpeg("merge", lambda codecs: self._merge_command(video_file, audio_file, output_files, codecs),
+                         [video_file, audio_file], output_files)
+        print("Merge completed.")
@@ -0,0 +1,182 @@
+"""
+Local library index: remembers every finished download so the same video at
+the same quality and format is never fetched twice. A repeat is satisfied by
+a hardlink (or a copy across drives) of the file already on disk.
+
+Usage:
+    python library.py stats
+    python library.py rebuild [FOLDER ...]
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+
+from utils import app_data_dir, format_bytes
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def file_hash(path):
+    """SHA-256 of a file, read in blocks so large videos do not have to fit in memory."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Library:
+    """
+    SQLite index of finished files keyed by (video ID, itag, output format).
+    The itag of a merged adaptive download is written as "video+audio", e.g. "137+140".
+    One connection is shared by all threads and guarded by a lock.
+    """
+    def __init__(self, db_path=None):
+        self.db_path = db_path or os.path.join(app_data_dir(), 'library.sqlite3')
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+        with self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    video_id TEXT NOT NULL,
+                    itag TEXT NOT NULL,
+                    format TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    added_at REAL NOT NULL,
+                    PRIMARY KEY (video_id, itag, format)
+                )""")
+            self._db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def lookup(self, video_id, itag, file_format):
+        """Returns the indexed path for a key if the file is still there and unchanged in size, else None."""
+        with self._lock:
+            row = self._db.execute("SELECT path, size FROM files WHERE video_id = ? AND itag = ? AND format = ?",
+                                   (video_id, str(itag), file_format)).fetchone()
+        if row is None:
+            return None
+        path, size = row
+        if not os.path.isfile(path) or os.path.getsize(path) != size:
+            self.forget(video_id, itag, file_format)
+            return None
+        return path
+
+    def record(self, video_id, itag, file_format, path):
+        """Indexes a finished file."""
+        size = os.path.getsize(path)
+        digest = file_hash(path)
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (video_id, str(itag), file_format, os.path.abspath(path), size, digest, time.time()))
+
+    def forget(self, video_id, itag, file_format):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM files WHERE video_id = ? AND itag = ? AND format = ?",
+                             (video_id, str(itag), file_format))
+
+    def materialize(self, source_path, target_path):
+        """
+        Puts a copy of an indexed file at `target_path`: a hardlink where the
+        filesystem allows it, a plain copy otherwise. Counts it as bytes saved.
+        """
+        # Build the link beside the target and swap it in, since the target may be a reserved placeholder
+        link_path = f"{target_path}.link"
+        try:
+            os.link(source_path, link_path)
+            os.replace(link_path, target_path)
+        except OSError:
+            if os.path.exists(link_path):
+                os.remove(link_path)
+            shutil.copy2(source_path, target_path)
+        self._count('hits', 1)
+        self._count('bytes_saved', os.path.getsize(source_path))
+        return target_path
+
+    def _count(self, name, amount):
+        with self._lock, self._db:
+            self._db.execute("INSERT INTO counters VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + ?",
+                             (name, amount, amount))
+
+    def stats(self):
+        with self._lock:
+            entries, total_size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files").fetchone()
+            counters = dict(self._db.execute("SELECT name, value FROM counters").fetchall())
+        return {'entries': entries, 'total_size': total_size,
+                'hits': counters.get('hits', 0), 'bytes_saved': counters.get('bytes_saved', 0)}
+
+    def rebuild(self, folders=None):
+        """
+        Re-validates the index against the disk. Every entry whose file is gone
+        or changed is looked for by hash in `folders` (by default the folders
+        the index already knows), so moved or renamed downloads are re-linked;
+        entries that cannot be found are dropped.
+        Returns a {'kept', 'relocated', 'dropped'} summary.
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT video_id, itag, format, path, size, sha256 FROM files").fetchall()
+        if not folders:
+            folders = sorted({os.path.dirname(row[3]) for row in rows})
+
+        # Index candidate files by size first, so only plausible matches get hashed
+        by_size = {}
+        for folder in folders:
+            for root, _, names in os.walk(folder):
+                for name in names:
+                    path = os.path.join(root, name)
+                    try:
+                        by_size.setdefault(os.path.getsize(path), []).append(path)
+                    except OSError:
+                        pass
+
+        summary = {'kept': 0, 'relocated': 0, 'dropped': 0}
+        hashes = {}
+        for video_id, itag, file_format, path, size, digest in rows:
+            if os.path.isfile(path) and os.path.getsize(path) == size:
+                summary['kept'] += 1
+                continue
+            match = None
+            for candidate in by_size.get(size, []):
+                if candidate not in hashes:
+                    hashes[candidate] = file_hash(candidate)
+                if hashes[candidate] == digest:
+                    match = candidate
+                    break
+            with self._lock, self._db:
+                if match:
+                    self._db.execute("UPDATE files SET path = ? WHERE video_id = ? AND itag = ? AND format = ?",
+                                     (os.path.abspath(match), video_id, itag, file_format))
+                    summary['relocated'] += 1
+                else:
+                    self._db.execute("DELETE FROM files WHERE video_id = ? AND itag = ? AND format = ?",
+                                     (video_id, itag, file_format))
+                    summary['dropped'] += 1
+        return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect or repair the local download library index.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('stats', help="Show index size and bytes saved by re-using files")
+    rebuild = commands.add_parser('rebuild', help="Rescan download folders and repair the index")
+    rebuild.add_argument('folders', nargs='*', help="Folders to scan (default: the folders already indexed)")
+    args = parser.parse_args(argv)
+
+    library = Library()
+    if args.command == 'rebuild':
+        summary = library.rebuild(args.folders)
+        print(f"Kept {summary['kept']}, relocated {summary['relocated']}, dropped {summary['dropped']} entries.")
+    else:
+        stats = library.stats()
+        print(f"Indexed files: {stats['entries']} ({format_bytes(stats['total_size'])})")
+        print(f"Re-used downloads: {stats['hits']}, saved {format_bytes(stats['bytes_saved'])} of transfers")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
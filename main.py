@@ -2,21 +2,20 @@ import tkinter as tk
 import ttkbootstrap as ttk
 from ttkbootstrap.constants import *
 from tkinter import filedialog, messagebox
-from PIL import Image, ImageTk
-import requests
-from io import BytesIO
 import threading
 import os
 import queue
 
-from downloader import YouTubeDownloader
+# The downloader core, the thumbnail cache, PIL and requests are imported by _load_core once the window is up
+from metrics import MetricsRecorder, span
+from utils import NotifyingQueue, ProgressAggregator, app_data_dir, format_bytes, format_eta, http_session
 # We no longer need show_message from utils as it's not thread-safe
 
 # Define a constant for the placeholder text to avoid errors
 PLACEHOLDER_TEXT = "Paste URL here... (don't use shortened links)"
 
 class FormatDialog(tk.Toplevel):
-    """A modal dialog to select the download format and quality."""
+    """A modal dialog to select the download formats and quality. Every ticked format is made from one download."""
     def __init__(self, parent, title, format_options, quality_options):
         super().__init__(parent)
         self.title(title)
@@ -32,10 +31,14 @@ class FormatDialog(tk.Toplevel):
         main_frame.columnconfigure(0, weight=1)
 
         # --- Format Selection ---
-        ttk.Label(main_frame, text="Please select a format:").grid(row=0, column=0, sticky="w")
-        self.format_var = tk.StringVar(value=format_options[0])
-        self.format_menu = ttk.Combobox(main_frame, textvariable=self.format_var, values=format_options, state="readonly")
-        self.format_menu.grid(row=1, column=0, sticky="ew", pady=(5, 15))
+        ttk.Label(main_frame, text="Please select one or more formats:").grid(row=0, column=0, sticky="w")
+        format_frame = ttk.Frame(main_frame)
+        format_frame.grid(row=1, column=0, sticky="ew", pady=(5, 15))
+        self.format_vars = []
+        for column, option in enumerate(format_options):
+            var = tk.BooleanVar(value=column == 0)
+            ttk.Checkbutton(format_frame, text=option, variable=var).grid(row=0, column=column, sticky="w", padx=(0, 10))
+            self.format_vars.append((option, var))
 
         # --- Quality Selection ---
         ttk.Label(main_frame, text="Please select a quality:").grid(row=2, column=0, sticky="w")
@@ -67,35 +70,12 @@ class FormatDialog(tk.Toplevel):
         self.geometry(f'{width}x{height}+{x}+{y}')
 
     def ok_pressed(self):
-        file_format = self.format_var.get().split(" ")[0].lower()
-        quality = self.quality_var.get()
-        self.result = (file_format, quality)
-        self.destroy()
-
-    def cancel_pressed(self):
-        self.result = None
-        self.destroy()
-
-    def show(self):
-        self.wait_window()
-        return self.result
-
-    def _center_window(self):
-        self.update_idletasks()
-        width = self.winfo_width()
-        height = self.winfo_height()
-        parent_x = self.master.winfo_x()
-        parent_y = self.master.winfo_y()
-        parent_width = self.master.winfo_width()
-        parent_height = self.master.winfo_height()
-        x = parent_x + (parent_width // 2) - (width // 2)
-        y = parent_y + (parent_height // 2) - (height // 2)
-        self.geometry(f'{width}x{height}+{x}+{y}')
-
-    def ok_pressed(self):
-        file_format = self.format_var.get().split(" ")[0].lower()
+        file_formats = [option.split(" ")[0].lower() for option, var in self.format_vars if var.get()]
+        if not file_formats:
+            messagebox.showwarning("No format", "Please select at least one format.", parent=self)
+            return
         quality = self.quality_var.get()
-        self.result = (file_format, quality)
+        self.result = (file_formats, quality)
         self.destroy()
 
     def cancel_pressed(self):
@@ -110,8 +90,11 @@ class App(ttk.Window):
     """
     The main application class for the YouTube Downloader GUI.
     """
-    def __init__(self):
+    def __init__(self, daemon_url=None, streaming=False):
         super().__init__()
+        # With a daemon URL the window is a thin client and jobs run in the shared daemon (see daemon.py)
+        self.daemon_url = daemon_url
+        self.streaming = tk.BooleanVar(value=streaming)
         self.title("Gaan ta Namao")
         self.geometry("700x280")
         self.minsize(700, 280)
@@ -119,7 +102,13 @@ class App(ttk.Window):
         self.info_frame = None
         self.available_resolutions = []
         self.available_bitrates = []
-        self.ui_queue = queue.Queue()
+        # The Tk thread sleeps until a worker puts something on the queue, instead of polling it
+        self._wake_lock = threading.Lock()
+        self._wake_pending = False
+        self.bind('<<UiQueue>>', lambda event: self._process_queue())
+        self.ui_queue = NotifyingQueue(self._wake_ui)
+        # Per-chunk progress is coalesced here and only reaches the queue a few times per second
+        self.progress = ProgressAggregator(lambda job_id: self.ui_queue.put(("show_progress", job_id)))
 
         # --- Theme and Styling ---
         MAIN_THEME = "#9ECFF5"
@@ -147,13 +136,57 @@ class App(ttk.Window):
         self.style.configure('Credit.TLabel', font=('Segoe UI', 7), foreground=BUTTON_TEXT)
 
         self.configure(bg=MAIN_THEME)
-        self.downloader = YouTubeDownloader(self.update_progress)
+        self.downloader = None
+        self._core_ready = threading.Event()
+        self._core_error = None
+        self.metrics = MetricsRecorder()
+        self._job_thread = None
+        self._closing = False
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
         self._center_window()
         self.create_widgets()
         self._load_app_icon()
-        self.after(100, self._process_queue)
+        threading.Thread(target=self._load_core, daemon=True).start()
+
+    def _load_core(self):
+        """Imports the downloader and network stack off the Tk thread, so the window shows first."""
+        try:
+            from cache import ThumbnailCache
+            # Warmed here too, so the first thumbnail does not pay for importing them
+            import PIL.Image
+            http_session()
+            self.thumbnails = ThumbnailCache()
+            if self.daemon_url:
+                from daemon import RemoteDownloader
+                self.downloader = RemoteDownloader(self.update_progress, self.daemon_url, self.update_transcode_progress)
+            else:
+                from downloader import YouTubeDownloader
+                from cache import MetadataCache
+                from library import Library
+                self.downloader = YouTubeDownloader(self.update_progress, metadata_cache=MetadataCache(), library=Library(),
+                                                    transcode_callback=self.update_transcode_progress)
+        except Exception as e:
+            self._core_error = e
+            print(f"Could not load the downloader: {e}")
+        finally:
+            self._core_ready.set()
+
+    def _wait_for_core(self):
+        self._core_ready.wait()
+        if self._core_error is not None:
+            raise RuntimeError(f"The downloader could not be loaded: {self._core_error}")
+
+    def _wake_ui(self):
+        """Asks the Tk thread to drain the UI queue, unless a wake-up is already pending."""
+        with self._wake_lock:
+            if self._wake_pending:
+                return
+            self._wake_pending = True
+        self.event_generate('<<UiQueue>>', when='tail')
 
     def _process_queue(self):
+        with self._wake_lock:
+            self._wake_pending = False
         try:
             while True:
                 message = self.ui_queue.get_nowait()
@@ -164,20 +197,75 @@ class App(ttk.Window):
                     self.title_label.config(text=value)
                 elif command == "update_progress":
                     self.progress_bar['value'] = value
+                elif command == "show_progress":
+                    self._show_progress(value)
+                elif command == "show_transcode":
+                    self._show_transcode(value)
                 elif command == "set_button_state":
                     widget_name, state = value
                     if widget_name == 'fetch': self.fetch_button.config(state=state)
                     elif widget_name == 'download': self.download_button.config(state=state)
+                    elif widget_name == 'cancel': self.cancel_button.config(state=state)
                 elif command == "show_message":
                     title, msg = value
                     messagebox.showinfo(title, msg)
                 elif command == "display_thumbnail":
+                    from PIL import ImageTk
                     self.thumbnail_image = ImageTk.PhotoImage(value)
                     self.thumbnail_label.config(image=self.thumbnail_image)
                 elif command == "create_info_frame":
                     self._create_and_show_info_frame()
         except queue.Empty:
-            self.after(100, self._process_queue)
+            pass
+
+    def _show_progress(self, job_id):
+        snapshot = self.progress.snapshot(job_id)
+        if snapshot is None:
+            return
+        self.progress_bar['value'] = snapshot['percentage']
+        status = f"Downloading... {int(snapshot['percentage'])}%"
+        if snapshot['rate']:
+            status += f"  ({format_bytes(snapshot['rate'])}/s, {format_eta(snapshot['eta'])} left)"
+        self.status_label.config(text=status)
+
+    def _show_transcode(self, event):
+        status = "Converting..."
+        if event['percentage'] is not None:
+            self.progress_bar['value'] = event['percentage']
+            status = f"Converting... {int(event['percentage'])}%"
+        if event['speed']:
+            status += f"  ({event['speed']:.1f}x speed)"
+        self.status_label.config(text=status)
+
+    def cancel_download(self):
+        """Stops the running job; transfers stop after their current chunk and ffmpeg is killed."""
+        if self._job_thread is None or not self._job_thread.is_alive():
+            return
+        self.cancel_button.config(state="disabled")
+        self.status_label.config(text="Cancelling...")
+        try:
+            self.downloader.cancel()
+        except Exception as e:
+            print(f"Could not cancel the download: {e}")
+
+    def on_close(self):
+        """
+        Cancels a running job and closes once it has stopped, so no ffmpeg process or partial file is left behind.
+        With --connect the job belongs to the daemon and carries on there, so the window closes straight away.
+        """
+        if self.daemon_url or self._job_thread is None or not self._job_thread.is_alive():
+            self.destroy()
+            return
+        self._closing = True
+        self.downloader.cancel()
+        self.status_label.config(text="Cancelling...")
+        self._close_when_idle()
+
+    def _close_when_idle(self):
+        if self._job_thread.is_alive():
+            self.after(100, self._close_when_idle)
+        else:
+            self.destroy()
 
     def _center_window(self):
         self.update_idletasks()
@@ -193,8 +281,8 @@ class App(ttk.Window):
         try:
             script_dir = os.path.dirname(__file__)
             logo_path = os.path.join(script_dir, "logo.png")
-            img = Image.open(logo_path)
-            self.logo_image = ImageTk.PhotoImage(img)
+            # Tk reads PNG itself, so PIL is not needed before the window appears
+            self.logo_image = tk.PhotoImage(file=logo_path)
             self.iconphoto(True, self.logo_image)
         except Exception as e:
             print(f"Could not load app icon: {e}")
@@ -238,8 +326,17 @@ class App(ttk.Window):
         video_btn.grid(row=0, column=0, sticky="ew", padx=(0,5))
         audio_btn = ttk.Radiobutton(bottom_frame, text="Audio", variable=self.download_type, value="audio", style='Toolbutton')
         audio_btn.grid(row=0, column=1, sticky="ew", padx=(5,0))
-        self.download_button = ttk.Button(bottom_controls_frame, text="Download", state="disabled", command=self.start_download, style='Success.TButton')
-        self.download_button.pack(fill=X, ipady=5, pady=(5, 10))
+        if not self.daemon_url:
+            # The daemon decides this for its own jobs (python daemon.py --stream)
+            stream_check = ttk.Checkbutton(bottom_frame, text="Stream into ffmpeg (no temp files)", variable=self.streaming)
+            stream_check.grid(row=1, column=0, columnspan=2, sticky="w", pady=(8, 0))
+        action_frame = ttk.Frame(bottom_controls_frame)
+        action_frame.pack(fill=X, pady=(5, 10))
+        action_frame.columnconfigure(0, weight=1)
+        self.download_button = ttk.Button(action_frame, text="Download", state="disabled", command=self.start_download, style='Success.TButton')
+        self.download_button.grid(row=0, column=0, sticky="ew", ipady=5)
+        self.cancel_button = ttk.Button(action_frame, text="Cancel", state="disabled", command=self.cancel_download)
+        self.cancel_button.grid(row=0, column=1, sticky="ns", padx=(5, 0))
         self.progress_bar = ttk.Progressbar(bottom_controls_frame, mode="determinate", style='Striped.Horizontal.TProgressbar')
         self.progress_bar.pack(fill=X, pady=5, ipady=2)
         footer_frame = ttk.Frame(self)
@@ -256,8 +353,8 @@ class App(ttk.Window):
         if self.winfo_height() < 550:
             self.geometry(f"700x550")
             self._center_window()
-        placeholder = Image.new('RGB', (240, 135), color="#F6FDFF")
-        self.thumbnail_image = ImageTk.PhotoImage(placeholder)
+        self.thumbnail_image = tk.PhotoImage(width=240, height=135)
+        self.thumbnail_image.put("#F6FDFF", to=(0, 0, 240, 135))
         self.thumbnail_label = ttk.Label(self.info_frame, image=self.thumbnail_image)
         self.thumbnail_label.grid(row=0, column=0, pady=5)
         self.title_label = ttk.Label(self.info_frame, text="Video title will appear here.", font=('Segoe UI', 11, 'bold'), wraplength=600, justify="center", anchor="center")
@@ -278,12 +375,16 @@ class App(ttk.Window):
 
     def _fetch_video_info_thread(self, url):
         try:
+            self._wait_for_core()
+            # One recorder per video; its spans are appended to metrics.jsonl when the download ends
+            self.metrics = MetricsRecorder()
+            self.downloader.job_metrics = self.metrics.job(url)
             video_info = self.downloader.get_video_info(url)
             self.available_resolutions = video_info.get('video_resolutions', [])
             self.available_bitrates = video_info.get('audio_bitrates', [])
             self.ui_queue.put(("create_info_frame", None))
             self.ui_queue.put(("update_title", video_info['title']))
-            self.display_thumbnail(video_info['thumbnail_url'])
+            self.display_thumbnail(self.downloader.video_id, video_info['thumbnail_url'])
             self.ui_queue.put(("set_button_state", ('download', 'normal')))
             self.ui_queue.put(("update_status", "Select Audio/Video then hit Download."))
         except Exception as e:
@@ -293,13 +394,10 @@ class App(ttk.Window):
         finally:
             self.ui_queue.put(("set_button_state", ('fetch', 'normal')))
 
-    def display_thumbnail(self, url):
+    def display_thumbnail(self, video_id, url):
         try:
-            response = requests.get(url, stream=True)
-            response.raise_for_status()
-            img_data = response.content
-            img = Image.open(BytesIO(img_data))
-            img.thumbnail((240, 135))
+            with span(self.downloader.job_metrics, 'thumbnail'):
+                img = self.thumbnails.get(video_id, url)
             self.ui_queue.put(("display_thumbnail", img))
         except Exception as e:
             print(f"Could not load thumbnail: {e}")
@@ -323,41 +421,71 @@ class App(ttk.Window):
         result = dialog.show()
 
         if not result: return
-        file_format, quality = result
+        file_formats, quality = result
 
         save_path = filedialog.askdirectory()
         if not save_path: return
 
         self.ui_queue.put(("set_button_state", ('download', 'disabled')))
         self.ui_queue.put(("set_button_state", ('fetch', 'disabled')))
+        self.progress.reset('download')
         self.ui_queue.put(("update_progress", 0))
         self.ui_queue.put(("update_status", "Starting download..."))
-        threading.Thread(target=self._download_thread, args=(download_type, save_path, file_format, quality), daemon=True).start()
-
-    def _download_thread(self, download_type, save_path, file_format, quality):
+        if not self.daemon_url:
+            self.downloader.streaming = self.streaming.get()
+        # Cleared here rather than on the job thread, so a Cancel pressed while it starts is not lost
+        self.downloader.begin_job()
+        self.cancel_button.config(state="normal")
+        self._job_thread = threading.Thread(target=self._download_thread, args=(download_type, save_path, file_formats, quality), daemon=True)
+        self._job_thread.start()
+
+    def _download_thread(self, download_type, save_path, file_formats, quality):
+        from downloader import DownloadCancelled
         try:
             if download_type == "video":
-                self.downloader.download_video(save_path, video_format=file_format, resolution=quality)
+                self.downloader.download_video(save_path, video_format=file_formats, resolution=quality)
             else:
-                self.downloader.download_audio(save_path, audio_format=file_format, bitrate=quality)
+                self.downloader.download_audio(save_path, audio_format=file_formats, bitrate=quality)
             self.ui_queue.put(("update_status", "Download completed successfully! 🎉"))
             self.ui_queue.put(("show_message", ("Success", f"{download_type.capitalize()} downloaded successfully!")))
+        except DownloadCancelled:
+            # Partial outputs are removed; .part files stay, so downloading again resumes
+            self.ui_queue.put(("update_status", "Download cancelled."))
         except Exception as e:
+            if self._closing:
+                return  # cancelled by closing the window; the finally block still runs
             self.ui_queue.put(("update_status", "Download failed."))
             self.ui_queue.put(("show_message", ("Error", f"An error occurred: {e}")))
         finally:
+            self._save_metrics()
             self.ui_queue.put(("update_progress", 0))
             self.ui_queue.put(("set_button_state", ('download', 'normal')))
             self.ui_queue.put(("set_button_state", ('fetch', 'normal')))
+            self.ui_queue.put(("set_button_state", ('cancel', 'disabled')))
+
+    def _save_metrics(self):
+        try:
+            self.metrics.export_jsonl(os.path.join(app_data_dir(), 'metrics.jsonl'))
+            self.metrics = MetricsRecorder()
+            self.downloader.job_metrics = self.metrics.job(self.downloader.url)
+        except Exception as e:
+            print(f"Could not save timing metrics: {e}")
 
     def update_progress(self, stream, chunk, bytes_remaining):
         total_size = stream.filesize
-        bytes_downloaded = total_size - bytes_remaining
-        percentage = (bytes_downloaded / total_size) * 100
-        self.ui_queue.put(("update_progress", percentage))
-        self.ui_queue.put(("update_status", f"Downloading... {int(percentage)}%"))
+        self.progress.update('download', total_size - bytes_remaining, total_size)
+
+    def update_transcode_progress(self, event):
+        # ffmpeg reports about twice a second, so its events go to the queue as they are
+        self.ui_queue.put(("show_transcode", event))
 
 if __name__ == "__main__":
-    app = App()
+    import argparse
+    parser = argparse.ArgumentParser(description="Gaan ta Namao YouTube downloader.")
+    parser.add_argument('--connect', nargs='?', const="http://127.0.0.1:8765", metavar='URL',
+                        help="Run as a client of a download daemon (default: http://127.0.0.1:8765)")
+    parser.add_argument('--stream', action='store_true', help="Tick 'Stream into ffmpeg' by default")
+    args = parser.parse_args()
+    app = App(daemon_url=args.connect, streaming=args.stream)
     app.mainloop()
 
@@ -0,0 +1,200 @@
+"""
+Phase-level timing for download jobs: metadata resolution, transfers,
+thumbnail fetches and ffmpeg runs are recorded as spans per job, and can be
+exported as JSON lines or as a Prometheus textfile (node_exporter's textfile
+collector format).
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource  # POSIX only; used for the CPU time of ffmpeg child processes
+except ImportError:
+    resource = None
+
+
+def _children_cpu_time():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Span:
+    """One timed phase of a job. Code inside the span may set `bytes` and extra attributes."""
+    def __init__(self, job_id, phase, attrs):
+        self.job_id = job_id
+        self.phase = phase
+        self.attrs = attrs
+        self.bytes = None
+        self.started_at = time.time()
+        self.duration = None
+        self.cpu_time = None
+        self.error = None
+
+    def to_dict(self):
+        data = {'job': self.job_id, 'phase': self.phase, 'started_at': self.started_at,
+                'duration': self.duration, 'error': self.error, **self.attrs}
+        if self.bytes is not None:
+            data['bytes'] = self.bytes
+            data['throughput'] = self.bytes / self.duration if self.duration else None
+        if self.cpu_time is not None:
+            data['cpu_time'] = self.cpu_time
+        return data
+
+
+class JobMetrics:
+    """The spans of one job."""
+    def __init__(self, job_id, recorder=None):
+        self.job_id = job_id
+        self.recorder = recorder
+        self.spans = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, phase, child_cpu=False, **attrs):
+        """
+        Times the enclosed block as `phase`. With child_cpu=True the CPU time of
+        child processes that finished inside the block (ffmpeg) is recorded too;
+        with several ffmpeg runs in parallel this figure is shared between them.
+        """
+        span = Span(self.job_id, phase, attrs)
+        cpu_before = _children_cpu_time() if child_cpu else None
+        started = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            span.duration = time.perf_counter() - started
+            if cpu_before is not None:
+                span.cpu_time = _children_cpu_time() - cpu_before
+            with self._lock:
+                self.spans.append(span)
+            if self.recorder is not None:
+                self.recorder._add(span)
+
+
+@contextmanager
+def span(job_metrics, phase, **attrs):
+    """Like JobMetrics.span, but a no-op (still yielding a Span) when `job_metrics` is None."""
+    if job_metrics is None:
+        yield Span(None, phase, attrs)
+    else:
+        with job_metrics.span(phase, **attrs) as s:
+            yield s
+
+
+class MetricsRecorder:
+    """Collects the spans of every job in a run and exports them."""
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def job(self, job_id):
+        return JobMetrics(job_id, recorder=self)
+
+    def _add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def export_jsonl(self, path):
+        """Appends one JSON object per span, so successive runs can share a file."""
+        with self._lock:
+            spans = list(self.spans)
+        with open(path, 'a', encoding='utf-8') as f:
+            for s in spans:
+                f.write(json.dumps(s.to_dict()) + "\n")
+
+    def export_prometheus(self, path):
+        """Writes per-phase totals as a Prometheus textfile, replacing it atomically."""
+        totals = {}
+        with self._lock:
+            for s in self.spans:
+                phase = totals.setdefault(s.phase, {'count': 0, 'errors': 0, 'seconds': 0.0, 'bytes': 0, 'cpu': 0.0})
+                phase['count'] += 1
+                phase['errors'] += 1 if s.error else 0
+                phase['seconds'] += s.duration or 0.0
+                phase['bytes'] += s.bytes or 0
+                phase['cpu'] += s.cpu_time or 0.0
+
+        metrics = [
+            ('gaan_phase_runs_total', 'counter', 'Number of times a job phase ran', 'count'),
+            ('gaan_phase_errors_total', 'counter', 'Number of job phases that failed', 'errors'),
+            ('gaan_phase_seconds_total', 'counter', 'Wall-clock seconds spent in a job phase', 'seconds'),
+            ('gaan_phase_bytes_total', 'counter', 'Bytes moved during a job phase', 'bytes'),
+            ('gaan_phase_child_cpu_seconds_total', 'counter', 'CPU seconds used by ffmpeg during a job phase', 'cpu'),
+        ]
+        lines = []
+        for name, kind, help_text, key in metrics:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for phase, values in sorted(totals.items()):
+                lines.append(f'{name}{{phase="{phase}"}} {values[key]}')
+
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, path)
+
+    def summary(self):
+        """Seconds per phase across all jobs, slowest first."""
+        totals = {}
+        with self._lock:
+            for s in self.spans:
+                totals[s.phase] = totals.get(s.phase, 0.0) + (s.duration or 0.0)
+        return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+
+
+# The profilers of worker threads started from a profiled() call, per thread
+_profiling = threading.local()
+
+
+def profiled(fn, output_path):
+    """
+    Wraps `fn` so that its call runs under cProfile, dumping stats to
+    `output_path`. cProfile only sees the thread it runs on, so work handed
+    to pool threads through profile_worker() gets a profiler of its own, and
+    their stats are merged into the same file.
+    """
+    import cProfile
+    import pstats
+
+    def wrapper(*args, **kwargs):
+        profiler = cProfile.Profile()
+        _profiling.workers = workers = []
+        try:
+            return profiler.runcall(fn, *args, **kwargs)
+        finally:
+            _profiling.workers = None
+            stats = pstats.Stats(profiler)
+            for worker_profiler in list(workers):
+                stats.add(worker_profiler)
+            stats.dump_stats(output_path)
+    return wrapper
+
+
+def profile_worker(fn):
+    """
+    Wraps a callable about to be handed to another thread. When the current
+    thread runs under profiled(), the callable is profiled on that thread too;
+    otherwise `fn` is returned unchanged.
+    """
+    workers = getattr(_profiling, 'workers', None)
+    if workers is None:
+        return fn
+    import cProfile
+
+    def wrapper(*args, **kwargs):
+        profiler = cProfile.Profile()
+        _profiling.workers = workers  # threads this one starts are profiled as well
+        try:
+            return profiler.runcall(fn, *args, **kwargs)
+        finally:
+            _profiling.workers = None
+            workers.append(profiler)
+    return wrapper
@@ -0,0 +1,154 @@
+"""
+Two-stage job pipeline: downloads run on one pool of workers and hand their
+finished files to a separate transcode pool sized to the CPU, so job N+1 can
+download while job N is being converted.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+
+# Tells a transcode worker to exit
+_STOP = object()
+
+
+class Pipeline:
+    """
+    Jobs are submitted as a `fetch` callable that does the network half of a
+    job and returns a downloader.TranscodeTask (or None when there is nothing
+    to convert). The transcode queue is bounded: when every transcode worker
+    is busy and the queue is full, download workers block before starting
+    more work, so finished temp files cannot pile up on disk.
+
+    Jobs should hand `cancel_event` to their downloaders: the pipeline sets
+    it when it is shut down early, e.g. by Ctrl+C inside its `with` block.
+    """
+    def __init__(self, download_workers=4, transcode_workers=None, queue_size=None):
+        self.download_workers = download_workers
+        self.transcode_workers = transcode_workers or os.cpu_count() or 1
+        self._downloads = ThreadPoolExecutor(max_workers=download_workers)
+        self._transcode_queue = queue.Queue(maxsize=queue_size or self.transcode_workers)
+        # Set when jobs that have not started yet should be dropped instead of run
+        self._dropping = threading.Event()
+        # Set when running jobs should stop as well
+        self.cancel_event = threading.Event()
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._stats = {'download_busy': 0.0, 'transcode_busy': 0.0, 'backpressure_wait': 0.0,
+                       'downloaded': 0, 'transcoded': 0, 'failed': 0, 'queue_peak': 0}
+        self._threads = [threading.Thread(target=self._transcode_worker, daemon=True)
+                         for _ in range(self.transcode_workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, fetch):
+        """
+        Queues a job. The returned Future resolves once both stages are done,
+        to the finished TranscodeTask, or None if no transcode was needed.
+        """
+        future = Future()
+        self._downloads.submit(self._download_stage, fetch, future)
+        return future
+
+    def _add(self, key, value):
+        with self._lock:
+            self._stats[key] += value
+
+    def _dropped(self, future):
+        self._add('failed', 1)
+        future.set_exception(CancelledError("Stopped before it started."))
+
+    def _download_stage(self, fetch, future):
+        if self._dropping.is_set():
+            self._dropped(future)
+            return
+        started = time.perf_counter()
+        try:
+            task = fetch()
+        except BaseException as e:
+            self._add('download_busy', time.perf_counter() - started)
+            self._add('failed', 1)
+            future.set_exception(e)
+            return
+        self._add('download_busy', time.perf_counter() - started)
+        self._add('downloaded', 1)
+
+        if task is None:
+            future.set_result(None)
+            return
+
+        # Blocks while the transcode stage is saturated, which is the backpressure
+        waited = time.perf_counter()
+        self._transcode_queue.put((task, future))
+        self._add('backpressure_wait', time.perf_counter() - waited)
+        with self._lock:
+            self._stats['queue_peak'] = max(self._stats['queue_peak'], self._transcode_queue.qsize())
+
+    def _transcode_worker(self):
+        while True:
+            item = self._transcode_queue.get()
+            if item is _STOP:
+                return
+            task, future = item
+            if self._dropping.is_set():
+                task.discard()
+                self._dropped(future)
+                continue
+            started = time.perf_counter()
+            try:
+                task.run()
+            except BaseException as e:
+                self._add('failed', 1)
+                future.set_exception(e)
+            else:
+                self._add('transcoded', 1)
+                future.set_result(task)
+            finally:
+                self._add('transcode_busy', time.perf_counter() - started)
+
+    def stats(self):
+        """
+        Per-stage utilisation: the share of each pool's worker-seconds spent
+        busy since the pipeline started, plus time download workers spent
+        blocked on a full transcode queue.
+        """
+        elapsed = time.perf_counter() - self._started
+        with self._lock:
+            stats = dict(self._stats)
+        stats['elapsed'] = elapsed
+        stats['download_utilisation'] = stats['download_busy'] / (elapsed * self.download_workers) if elapsed else 0
+        stats['transcode_utilisation'] = stats['transcode_busy'] / (elapsed * self.transcode_workers) if elapsed else 0
+        return stats
+
+    def format_stats(self):
+        stats = self.stats()
+        return (f"Download stage: {self.download_workers} workers, {stats['download_utilisation']:.0%} busy, "
+                f"{stats['backpressure_wait']:.1f}s blocked on transcode queue\n"
+                f"Transcode stage: {self.transcode_workers} workers, {stats['transcode_utilisation']:.0%} busy, "
+                f"queue peak {stats['queue_peak']}")
+
+    def shutdown(self, drop_pending=False, cancel_running=False):
+        """
+        Waits for every submitted job to finish both stages, then stops the
+        workers. With drop_pending, jobs that have not started fail with
+        CancelledError instead of running; with cancel_running, running jobs
+        are told to stop through `cancel_event` too.
+        """
+        if drop_pending:
+            self._dropping.set()
+        if cancel_running:
+            self.cancel_event.set()
+        self._downloads.shutdown(wait=True)
+        for _ in self._threads:
+            self._transcode_queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Leaving on an error (or Ctrl+C) must not quietly work through the rest of the queue
+        failed = exc_type is not None
+        self.shutdown(drop_pending=failed, cancel_running=failed)
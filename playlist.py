@@ -0,0 +1,149 @@
+"""
+Playlist and channel expansion: turns a playlist or channel URL into the
+URLs of its videos. While the listing pages in, each video's metadata is
+resolved on a bounded pool of workers and handed out as soon as it is
+ready, so a batch can start downloading the first entries while the rest
+of the list is still being read. A video that appears twice (in one list or
+across several) is expanded only once per key, e.g. per download policy.
+
+Usage:
+    python playlist.py "https://www.youtube.com/playlist?list=..." > urls.txt
+"""
+import argparse
+import re
+import sys
+import threading
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from cache import MetadataCache
+from downloader import YouTubeDownloader
+
+# Metadata resolutions in flight at once
+DEFAULT_WORKERS = 8
+# How many resolutions may be queued per worker before the listing waits
+QUEUE_PER_WORKER = 2
+
+_VIDEO_ID = re.compile(r"(?:v=|/)([0-9A-Za-z_-]{11})")
+_CHANNEL_PREFIXES = ('/@', '/channel/', '/c/', '/user/')
+
+
+def collection_kind(url):
+    """'playlist', 'channel' or None for a single video. A watch URL inside a playlist counts as the video."""
+    parsed = urllib.parse.urlparse(url)
+    query = urllib.parse.parse_qs(parsed.query)
+    if 'list' in query and 'v' not in query:
+        return 'playlist'
+    if parsed.path.startswith(_CHANNEL_PREFIXES):
+        return 'channel'
+    return None
+
+
+def video_url(url):
+    """The canonical watch URL of a video URL, so different spellings of one video compare equal."""
+    match = _VIDEO_ID.search(url)
+    return f"https://www.youtube.com/watch?v={match.group(1)}" if match else url
+
+
+def _open_collection(url):
+    from pytubefix import Channel, Playlist
+
+    return Channel(url) if collection_kind(url) == 'channel' else Playlist(url)
+
+
+class PlaylistExpander:
+    """
+    Expands URLs into videos. `open_collection(url)` returns an object with a
+    `title` and an iterable of `video_urls` (pytubefix's Playlist or Channel
+    by default); `resolve(url)` returns a video's get_video_info dict (by
+    default from a YouTubeDownloader sharing `metadata_cache`, which is what
+    lets the later download skip resolving the video again). Both can be
+    replaced, e.g. by offline stubs. With prefetch=False entries are only
+    listed, not resolved.
+    """
+    def __init__(self, metadata_cache=None, workers=DEFAULT_WORKERS, prefetch=True, open_collection=None, resolve=None):
+        self.metadata_cache = metadata_cache
+        self.workers = max(1, workers)
+        self.prefetch = prefetch
+        self.open_collection = open_collection or _open_collection
+        self.resolve = resolve or self._resolve
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def _resolve(self, url):
+        return YouTubeDownloader(metadata_cache=self.metadata_cache).get_video_info(url)
+
+    def _claim(self, url, key):
+        """True the first time a video is seen by this expander under `key`."""
+        with self._lock:
+            if (url, key) in self._seen:
+                return False
+            self._seen.add((url, key))
+            return True
+
+    def _prefetch(self, url):
+        try:
+            return url, self.resolve(url)
+        except Exception as e:
+            # The download of this entry resolves it again and reports the error
+            print(f"Could not resolve '{url}' ahead of time: {e}", file=sys.stderr)
+            return url, None
+
+    def expand(self, url, key=None):
+        """
+        Yields (video_url, info) for every video behind `url` that this
+        expander has not yielded before under the same `key`: the videos of a
+        playlist or channel in the order their metadata finishes resolving, or
+        the URL itself. A batch passes its download policy as the key, so the
+        same video can still be fetched once as audio and once as video.
+        `info` is the video's get_video_info dict, or None when it was not
+        prefetched or could not be resolved.
+        """
+        if collection_kind(url) is None:
+            url = video_url(url)
+            if self._claim(url, key):
+                yield url, None
+            return
+
+        collection = self.open_collection(url)
+        # Status goes to stderr, so the listing on stdout can be redirected into a batch file
+        print(f"Expanding '{getattr(collection, 'title', url)}'...", file=sys.stderr)
+        limit = self.workers * QUEUE_PER_WORKER
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = set()
+            for entry in collection.video_urls:
+                entry = video_url(entry)
+                if not self._claim(entry, key):
+                    continue
+                if not self.prefetch:
+                    yield entry, None
+                    continue
+                pending.add(pool.submit(self._prefetch, entry))
+                # Hand out whatever has finished; block only when the queue is full
+                done, pending = wait(pending, timeout=None if len(pending) >= limit else 0, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List the videos of YouTube playlists or channels, one URL per line.")
+    parser.add_argument('urls', nargs='+', help="Playlist or channel URLs")
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS, help="Number of parallel metadata lookups")
+    parser.add_argument('--no-cache', action='store_true', help="Only list the videos, without resolving them into the metadata cache")
+    args = parser.parse_args(argv)
+
+    expander = PlaylistExpander(None if args.no_cache else MetadataCache(), workers=args.workers, prefetch=not args.no_cache)
+    for url in args.urls:
+        for entry, info in expander.expand(url):
+            if info is not None:
+                print(f"# {info['title']}")
+            print(entry, flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
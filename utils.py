@@ -1,11 +1,202 @@
-# This file is no longer needed for show_message as it's not thread-safe.
-# You can keep it if you plan to add other utility functions,
-# or you can safely delete it.
+"""Small helpers shared by the GUI, the batch runner and the downloader core."""
+import os
+import queue
+import sys
+import threading
+import time
 
-# The original show_message function is removed because creating a new
-# tk.Tk() instance inside a function, especially when called from threads,
-# is a bad practice and can lead to instability and crashes.
-# The message box logic has been moved into the main App class
-# and is called safely via the UI queue.
+APP_NAME = "Gaan ta Namao"
+# Connections the shared HTTP session keeps open per host; enough for two streams' parallel ranges
+HTTP_POOL_SIZE = 16
+# (connect, read) timeout in seconds for every request, so a stalled connection fails instead of hanging its worker
+HTTP_TIMEOUT = (10, 30)
 
+_http_session = None
+_http_session_lock = threading.Lock()
 
+
+def app_data_dir(*parts):
+    """
+    Returns (and creates) a per-user folder for caches and indexes,
+    e.g. %LOCALAPPDATA%\\Gaan ta Namao\\metadata on Windows or
+    ~/.cache/gaan-ta-namao/metadata elsewhere.
+    """
+    if sys.platform == 'win32':
+        base = os.path.join(os.environ.get('LOCALAPPDATA', os.path.expanduser('~')), APP_NAME)
+    else:
+        base = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'gaan-ta-namao')
+    path = os.path.join(base, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def http_session():
+    """
+    The process-wide requests.Session. Every direct HTTP request the app makes
+    goes through it, so connections and TLS handshakes to a host are re-used
+    instead of being set up again per request. requests is imported on first use.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+        return _http_session
+
+
+def format_bytes(count):
+    """Human-readable size, e.g. 1.5 MB."""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if count < 1024 or unit == 'GB':
+            return f"{count:.1f} {unit}" if unit != 'B' else f"{int(count)} B"
+        count /= 1024
+
+
+def format_eta(seconds):
+    """Remaining time as m:ss or h:mm:ss."""
+    if seconds is None:
+        return "--:--"
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}" if hours else f"{minutes}:{seconds:02}"
+
+
+class NotifyingQueue(queue.Queue):
+    """A queue that calls `notify` after every put, so the consumer can wake up instead of polling."""
+    def __init__(self, notify=None):
+        super().__init__()
+        self.notify = notify
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        if self.notify:
+            self.notify()
+
+
+class ProgressAggregator:
+    """
+    Coalesces per-chunk progress into at most one update per `min_interval`
+    seconds per job. Only the latest state of each job is kept, along with an
+    exponentially smoothed transfer rate and the ETA derived from it.
+    `publish(job_id)` is called when a job has news worth showing; the
+    consumer then reads it with `snapshot(job_id)`.
+    """
+    def __init__(self, publish=None, min_interval=0.1, smoothing=0.3, clock=time.monotonic):
+        self.publish = publish
+        self.min_interval = min_interval
+        self.smoothing = smoothing
+        self.clock = clock
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def reset(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def update(self, job_id, done, total):
+        now = self.clock()
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                job = self._jobs[job_id] = {'done': done, 'total': total, 'rate': None,
+                                            'sample_time': now, 'sample_done': done, 'published': None}
+            job['done'], job['total'] = done, total
+
+            # Fold the bytes since the last sample into the smoothed rate
+            elapsed = now - job['sample_time']
+            if elapsed >= self.min_interval:
+                rate = (done - job['sample_done']) / elapsed
+                job['rate'] = rate if job['rate'] is None else self.smoothing * rate + (1 - self.smoothing) * job['rate']
+                job['sample_time'], job['sample_done'] = now, done
+
+            finished = total and done >= total
+            due = job['published'] is None or now - job['published'] >= self.min_interval
+            if not (due or finished):
+                return
+            job['published'] = now
+
+        if self.publish:
+            self.publish(job_id)
+
+    def snapshot(self, job_id):
+        """The latest {'done', 'total', 'percentage', 'rate', 'eta'} of a job, or None."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            done, total, rate = job['done'], job['total'], job['rate']
+        percentage = done / total * 100 if total else 0
+        eta = (total - done) / rate if rate else None
+        return {'done': done, 'total': total, 'percentage': percentage, 'rate': rate, 'eta': eta}
+
+
+class FilenameAllocator:
+    """
+    Hands out unique output paths ("name.ext", "name (1).ext", ...).
+    Each directory is listed once into an in-memory index, so picking a name
+    costs no existence checks per candidate. A name is reserved by creating an
+    empty placeholder with an exclusive create, so two workers (or two
+    processes) can never be given the same file. The job then overwrites the
+    placeholder with its output, or calls release() if it fails.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = {}         # directory -> normcased names present
+        self._next_counter = {}  # (directory, name, ext) -> first counter worth trying
+        self._reserved = {}      # reserved path -> the (directory, name, ext) key it was picked under
+
+    def _directory_names(self, directory):
+        names = self._names.get(directory)
+        if names is None:
+            try:
+                names = {os.path.normcase(name) for name in os.listdir(directory)}
+            except FileNotFoundError:
+                names = set()
+            self._names[directory] = names
+        return names
+
+    def reserve(self, file_path):
+        directory, filename = os.path.split(os.path.abspath(file_path))
+        name, extension = os.path.splitext(filename)
+        key = (directory, os.path.normcase(name), os.path.normcase(extension))
+
+        with self._lock:
+            names = self._directory_names(directory)
+            counter = self._next_counter.get(key, 0)
+            while True:
+                candidate = filename if counter == 0 else f"{name} ({counter}){extension}"
+                counter += 1
+                if os.path.normcase(candidate) in names:
+                    continue
+                path = os.path.join(directory, candidate)
+                try:
+                    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                except FileExistsError:
+                    # Created behind our back, e.g. by another process
+                    names.add(os.path.normcase(candidate))
+                    continue
+                names.add(os.path.normcase(candidate))
+                self._next_counter[key] = counter
+                self._reserved[os.path.normcase(path)] = key
+                return path
+
+    def release(self, file_path):
+        """Frees a reserved name whose job failed, removing the placeholder or partial output."""
+        directory, filename = os.path.split(os.path.abspath(file_path))
+        with self._lock:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            self._directory_names(directory).discard(os.path.normcase(filename))
+            # Let the freed name be handed out again. The key is the one the name was picked
+            # under: "Song (Live).mp4" is the first choice for "Song (Live)", not a counter of "Song".
+            key = self._reserved.pop(os.path.normcase(os.path.join(directory, filename)), None)
+            if key is not None:
+                self._next_counter.pop(key, None)